@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# asyncCsoundSession.py:
+#
+# Copyright (C) 2016 Francois Pinot
+#
+# This code is free software; you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this code; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# 02111-1307 USA
+#
+
+import asyncio
+import concurrent.futures
+import os
+from csoundSession import CsoundSession
+
+class AsyncCsoundSession:
+    """An asyncio front-end for a CsoundSession
+
+    Calls that only queue a message for the performance thread are made
+    directly from the event loop. Blocking calls run on a single worker
+    thread owned by the front-end, so that no executor has to be managed
+    by the caller and no thread is created per call.
+    """
+
+    def __init__(self, csdFileName=None, session=None):
+        """Wrap session, or a new session eventually loading a csd file
+
+        A new session buffers the csound messages so that they can be read
+        with the messages async iterator.
+        """
+        if session is None:
+            session = CsoundSession()
+            session.createMessageBuffer(0)
+            if csdFileName and os.path.exists(csdFileName):
+                session.csd = csdFileName
+                session.startThread()
+        self.session = session
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def isRunning(self):
+        """Return True while the performance thread is playing"""
+        pt = self.session.pt
+        return pt is not None and pt.status() == 0
+
+    async def note(self, pfields, absp2mode=0):
+        """Send a score note to a csound instrument"""
+        self.session.note(pfields, absp2mode)
+
+    async def scoreEvent(self, eventType, pfields, absp2mode=False):
+        """Send a score event to csound"""
+        self.session.scoreEvent(eventType, pfields, absp2mode)
+
+    async def scoreEvents(self, events, eventType='i', absp2mode=False):
+        """Send many score events at once to csound"""
+        self.session.scoreEvents(events, eventType, absp2mode)
+
+    async def flushMessages(self):
+        """Wait until all pending messages are actually received by the performance thread"""
+        await self._run(self.session.flushMessages)
+
+    async def stopPerformance(self):
+        """Stop the current score performance if any"""
+        await self._run(self.session.stopPerformance)
+
+    async def channel(self, name, interval=0.01, changesOnly=True):
+        """Iterate over the values of a control channel while performing
+
+        The channel is read every interval seconds. If changesOnly is True,
+        a value is only yielded when it differs from the previous one.
+        """
+        last = None
+        while self.isRunning():
+            value, err = self.session.controlChannel(name)
+            if not changesOnly or value != last:
+                last = value
+                yield value
+            await asyncio.sleep(interval)
+
+    async def messages(self, interval=0.05):
+        """Iterate over the csound messages as (attr, text) while performing
+
+        The message buffer is drained every interval seconds.
+        """
+        cs = self.session
+        while True:
+            running = self.isRunning()
+            while cs.messageCnt() > 0:
+                yield cs.firstMessageAttr(), cs.firstMessage()
+                cs.popFirstMessage()
+            if not running:
+                break
+            await asyncio.sleep(interval)
+
+    def close(self):
+        """Release the worker thread of the front-end"""
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
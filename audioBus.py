@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# audioBus.py:
+#
+# Copyright (C) 2016 Francois Pinot
+#
+# This code is free software; you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this code; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# 02111-1307 USA
+#
+
+import multiprocessing
+import time
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+import numpy as np
+import ctcsound
+from csoundSession import CsoundSession
+
+
+class AudioBus:
+    """A single-producer single-consumer ring of audio blocks in shared memory
+
+    The bus connects the output buffer of an engine to the input buffer of
+    an engine running in another process, without pickling. Blocks are
+    numbered: the n-th block got by the reader is the n-th block put by the
+    writer, so that the stages of a pipeline stay sample-accurate. The
+    writer waits when the ring is full, the reader when it is empty. A bus
+    is created by one process and attached by name in the others; the
+    creator unlinks the shared memory when it is closed.
+    """
+
+    _WRITE, _READ, _FRAMES, _NCHNLS, _SLOTS, _ITEMSIZE, _FINISHED, _STOPPED = range(8)
+    _headerSize = 64
+
+    def __init__(self, frames=None, nchnls=1, slots=8, name=None):
+        """Create a bus of slots blocks of (frames, nchnls) MYFLT samples,
+        or attach the existing bus named name"""
+        if shared_memory is None:
+            raise RuntimeError("AudioBus needs multiprocessing.shared_memory (python >= 3.8)")
+        self.owner = name is None
+        if self.owner:
+            itemsize = np.dtype(ctcsound.MYFLT).itemsize
+            size = self._headerSize + slots * frames * nchnls * itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            try:
+                # The creator owns the segment: do not let the resource
+                # tracker unlink it when this process exits
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except (ImportError, AttributeError, KeyError):
+                pass
+        self.header = np.ndarray((8,), np.int64, self.shm.buf)
+        if self.owner:
+            self.header[:] = (0, 0, frames, nchnls, slots, itemsize, 0, 0)
+        frames, nchnls, slots, itemsize = self.header[self._FRAMES:self._FINISHED]
+        self.name = self.shm.name
+        self.shape = (int(frames), int(nchnls))
+        self.slots = int(slots)
+        self.blocks = np.ndarray((self.slots,) + self.shape, 'f{}'.format(itemsize),
+                                 self.shm.buf, self._headerSize)
+
+    def put(self, block):
+        """Append a block, waiting for a free slot
+
+        Return False if the bus was stopped.
+        """
+        h = self.header
+        n = h[self._WRITE]
+        if not self._wait(lambda: n - h[self._READ] < self.slots):
+            return False
+        self.blocks[n % self.slots] = block
+        h[self._WRITE] = n + 1
+        return True
+
+    def get(self, out):
+        """Copy the next block into out, waiting for it
+
+        Return False at the end of the stream or if the bus was stopped.
+        """
+        h = self.header
+        n = h[self._READ]
+        if not self._wait(lambda: h[self._WRITE] > n or h[self._FINISHED]):
+            return False
+        if h[self._WRITE] == n:
+            return False
+        out[:] = self.blocks[n % self.slots]
+        h[self._READ] = n + 1
+        return True
+
+    def finish(self):
+        """Mark the end of the stream, once the blocks put have been read"""
+        self.header[self._FINISHED] = 1
+
+    def stop(self):
+        """Stop the bus: put() and get() return False from now on"""
+        self.header[self._STOPPED] = 1
+
+    def pending(self):
+        """Return the number of blocks put and not read yet"""
+        return int(self.header[self._WRITE] - self.header[self._READ])
+
+    def close(self):
+        """Release the shared memory, unlinking it if this bus created it"""
+        self.header = self.blocks = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def _wait(self, ready):
+        delay = 0.0
+        while not ready():
+            if self.header[self._STOPPED]:
+                return False
+            time.sleep(delay)
+            delay = min(2 * delay or 1e-5, 1e-3)
+        return not self.header[self._STOPPED]
+
+
+def _bufferShapes(csd, bufferSize):
+    """Return the sample rate and the (frames, channels) of the input and
+    output buffers of a csd performed with host implemented audio I/O"""
+    cs = ctcsound.Csound()
+    cs.createMessageBuffer(0)
+    cs.setHostImplementedAudioIO(1, bufferSize)
+    if cs.compile_("csoundSession", csd) != 0:
+        raise ValueError("{} could not be compiled".format(csd))
+    nchnls, nchnlsIn = cs.nchnls(), cs.nchnlsInput()
+    frames = cs.outputBufferSize() // nchnls
+    shapes = cs.sr(), (frames, nchnlsIn), (frames, nchnls)
+    cs.cleanup()
+    cs.reset()
+    return shapes
+
+
+def _runStage(csd, inName, outName, bufferSize):
+    """Perform one stage of an AudioPipeline in a worker process"""
+    inBus = AudioBus(name=inName) if inName else None
+    outBus = AudioBus(name=outName) if outName else None
+    cs = CsoundSession()
+    cs.csd = csd
+    cs.performBus(inBus, outBus, bufferSize)
+    for bus in (inBus, outBus):
+        if bus:
+            bus.close()
+
+
+class AudioPipeline:
+    """A fixed chain of csd files, each performed in its own process
+
+    The output of each stage feeds the input of the next one through an
+    AudioBus, so that a heavy processing chain can be spread over several
+    cores. The stages must share the sample rate and the buffer size, and
+    the output channels of a stage must match the input channels of the
+    next one. The output of the last stage is yielded by iterating over the
+    pipeline, block by block, as ndarrays of shape (frames, nchnls), which
+    are only valid until the next iteration. Each stage runs at most slots
+    blocks ahead of the next one.
+    """
+
+    def __init__(self, csdFileNames, bufferSize=256, slots=8):
+        self.csds = list(csdFileNames)
+        self.bufferSize = bufferSize
+        shapes = [_bufferShapes(csd, bufferSize) for csd in self.csds]
+        for (srA, _, outShape), (srB, inShape, _), csd in zip(shapes, shapes[1:], self.csds[1:]):
+            if srA != srB or outShape != inShape:
+                raise ValueError("{} expects {} at {} Hz, got {} at {} Hz".format(
+                    csd, inShape, srB, outShape, srA))
+        self.buses = [AudioBus(shape[2][0], shape[2][1], slots) for shape in shapes]
+        self.processes = []
+        for i, csd in enumerate(self.csds):
+            inName = self.buses[i - 1].name if i > 0 else None
+            p = multiprocessing.Process(target=_runStage,
+                                        args=(csd, inName, self.buses[i].name, bufferSize))
+            p.daemon = True
+            self.processes.append(p)
+        self.started = False
+
+    def start(self):
+        """Start the stage processes"""
+        if not self.started:
+            self.started = True
+            for p in self.processes:
+                p.start()
+
+    def __iter__(self):
+        self.start()
+        bus = self.buses[-1]
+        block = np.zeros(bus.shape, bus.blocks.dtype)
+        try:
+            while bus.get(block):
+                yield block
+        finally:
+            bus.stop()
+
+    def close(self):
+        """Stop the stages, wait for them and release the buses"""
+        for bus in self.buses:
+            bus.stop()
+        if self.started:
+            for p in self.processes:
+                p.join()
+        for bus in self.buses:
+            bus.close()
+        self.buses = []
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# bench_ctcsound.py:
+#
+# Copyright (C) 2016 Francois Pinot
+#
+# This code is free software; you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this code; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# 02111-1307 USA
+#
+
+"""Benchmarks of the hot paths of the ctcsound binding.
+
+All the benchmarks run headless (-n, no audio device). The results are
+written as JSON and can be compared against a stored baseline:
+
+    python bench_ctcsound.py -o bench.json
+    python bench_ctcsound.py --baseline bench_baseline.json --threshold 0.25
+
+The script exits with status 1 when a metric regressed by more than the
+threshold relative to the baseline.
+"""
+
+import argparse, importlib.util, json, os, platform, subprocess, sys, time
+import ctcsound, numpy as np, ctypes as ct
+
+orc = '''
+sr     = 48000
+ksmps  = 32
+nchnls = 2
+0dbfs  = 1
+
+          instr 1
+          chnset    1, "started"
+a1        oscili    0.1, 440
+          outs      a1, a1
+          endin
+
+          instr 2
+k1        chnget    "in"
+          chnset    k1, "out"
+          endin
+'''
+
+# Each metric is registered with True if higher values are better
+metrics = {}
+
+
+def metric(name, higherIsBetter):
+    metrics[name] = higherIsBetter
+    return name
+
+
+def newCsound(score='f 0 3600'):
+    cs = ctcsound.Csound()
+    cs.setOption('-n')
+    cs.setOption('-d')
+    cs.setOption('-m0')
+    cs.compileOrc(orc)
+    cs.readScore(score)
+    cs.start()
+    return cs
+
+
+def timeit(func, minTime=0.5):
+    """Call func repeatedly for at least minTime seconds, return calls per second"""
+    n, elapsed = 0, 0.0
+    t0 = time.perf_counter()
+    while elapsed < minTime:
+        func()
+        n += 1
+        elapsed = time.perf_counter() - t0
+    return n / elapsed
+
+
+def bench_perform(results):
+    cs = newCsound('i 1 0 3600')
+    ksmps = cs.ksmps()
+    rate = timeit(cs.performKsmps)
+    results[metric('performKsmps_calls_per_s', True)] = rate
+    results[metric('performKsmps_realtime_ratio', True)] = rate * ksmps / cs.sr()
+    rate = timeit(cs.performBuffer)
+    results[metric('performBuffer_calls_per_s', True)] = rate
+    results[metric('performBuffer_realtime_ratio', True)] = (
+        rate * cs.outputBufferSize() / cs.nchnls() / cs.sr())
+    cs.cleanup()
+    cs.reset()
+
+
+def bench_scoreEventLatency(results, count=50, timeout=1.0):
+    cs = newCsound()
+    chn, err = cs.channelPtr('started',
+        ctcsound.CSOUND_CONTROL_CHANNEL | ctcsound.CSOUND_OUTPUT_CHANNEL)
+    pt = ctcsound.CsoundPerformanceThread(cs.csound())
+    pt.play()
+    latencies, cycles = [], []
+    for i in range(count):
+        chn[0] = 0
+        k0 = cs.currentTimeSamples()
+        t0 = time.perf_counter()
+        pt.scoreEvent(False, 'i', (1, 0, 0.001))
+        while chn[0] == 0 and time.perf_counter() - t0 < timeout:
+            pass
+        latencies.append(time.perf_counter() - t0)
+        cycles.append((cs.currentTimeSamples() - k0) / cs.ksmps())
+    pt.stop()
+    pt.join()
+    cs.reset()
+    results[metric('scoreEvent_latency_median_s', False)] = float(np.median(latencies))
+    results[metric('scoreEvent_latency_p95_s', False)] = float(np.percentile(latencies, 95))
+    results[metric('scoreEvent_latency_median_kcycles', False)] = float(np.median(cycles))
+
+
+def bench_channels(results):
+    cs = newCsound('i 2 0 3600')
+    results[metric('setControlChannel_calls_per_s', True)] = timeit(
+        lambda: cs.setControlChannel('in', 0.5))
+    results[metric('controlChannel_calls_per_s', True)] = timeit(
+        lambda: cs.controlChannel('out'))
+    cs.cleanup()
+    cs.reset()
+
+
+def bench_tables(results, size=1 << 20):
+    cs = newCsound('f 1 0 {} 10 1'.format(size))
+    cs.performKsmps()
+    nbytes = size * cs.sizeOfMYFLT()
+    table = cs.table(1)
+    src = np.random.uniform(-1, 1, size).astype(ctcsound.MYFLT)
+    dst = np.empty_like(src)
+    results[metric('table_read_bytes_per_s', True)] = nbytes * timeit(
+        lambda: np.copyto(dst, cs.table(1)))
+    results[metric('tableCopyOut_bytes_per_s', True)] = nbytes * timeit(
+        lambda: cs.tableCopyOut(1, dst))
+    results[metric('tableCopyIn_bytes_per_s', True)] = nbytes * timeit(
+        lambda: cs.tableCopyIn(1, src))
+
+    def fillTable():
+        p = src.ctypes.data_as(ct.POINTER(ctcsound.MYFLT))
+        t = table.ctypes.data_as(ct.POINTER(ctcsound.MYFLT))
+        ct.memmove(t, p, nbytes)
+    results[metric('fillTable_memmove_bytes_per_s', True)] = nbytes * timeit(fillTable)
+    cs.cleanup()
+    cs.reset()
+
+
+def bench_compileOrc(results):
+    cs = newCsound()
+    code = '\n'.join('''
+          instr {0}
+a1        oscili    0.1, {0}
+          outs      a1, a1
+          endin
+'''.format(i) for i in range(100, 200))
+    t0 = time.perf_counter()
+    cs.compileOrc(code)
+    results[metric('compileOrc_100_instr_s', False)] = time.perf_counter() - t0
+    cs.cleanup()
+    cs.reset()
+
+
+def bench_csoundmagicsImport(results, repeat=5):
+    """Import time of the csoundmagics extension in a fresh interpreter.
+
+    The extension must not load numpy, matplotlib or libcsound when it is
+    imported; those are only loaded when the first engine is created.
+    Skipped when IPython is not installed.
+    """
+    if importlib.util.find_spec('IPython') is None:
+        return
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'cookbook', 'csoundmagics')
+    code = ('import sys, time; t0 = time.perf_counter(); import csoundmagics; '
+            'print(time.perf_counter() - t0)')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [path, env.get('PYTHONPATH')]))
+    best = None
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        elapsed = float(out.decode().split()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    results[metric('csoundmagics_import_s', False)] = best
+
+
+benchmarks = [bench_perform, bench_scoreEventLatency, bench_channels,
+              bench_tables, bench_compileOrc, bench_csoundmagicsImport]
+
+
+def runAll():
+    results = {}
+    for bench in benchmarks:
+        bench(results)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Return the list of (name, baseline, current, change) regressions"""
+    regressions = []
+    for name, value in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        change = (value - base) / base
+        if metrics[name]:
+            change = -change
+        if change > threshold:
+            regressions.append((name, base, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    current = runAll()
+    for name, value in sorted(current['results'].items()):
+        print('{:40s} {:.6g}'.format(name, value))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, base, value, change in regressions:
+            print('REGRESSION {}: {:.6g} -> {:.6g} ({:+.0%})'.format(name, base, value, change))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -53,10 +53,11 @@ class CsoundMagics(Magics):
         
         %csound n, where n < 0, erases slot#abs(n) bound to an ICsound engine.
         It is normally followed by the 'del ics' command.
-        %csound 0 erases slot#0 reserved to an ctcsound.Csound() instance used
-        by the runCsd and runOrcSco functions. Il also deletes this instance.
-        A call to runCsd or runOrcCsd will automatically create an
-        ctcsound.Csound instance bound to slot#0.
+        %csound 0 erases slot#0 reserved to an ctcsound.Csound() instance
+        returned by the getCsound function. Il also deletes this instance.
+        A call to getCsound will automatically create an ctcsound.Csound
+        instance bound to slot#0. The runCsd and runOrcSco functions use the
+        engines of the engine pool returned by getEnginePool.
         
         %%csound n where n is in [1 .. maxSlotNum] sends Csound code to the
         ICsound engine bound to slot#n. If n is omitted, slot#1 is used.
@@ -71,9 +72,7 @@ class CsoundMagics(Magics):
                     return line
                 slot = -slot
                 if slot <= maxSlotNum and slots[slot]:
-                    if slot == 0:
-                        del slots[slot]
-                    slots[slot] = None
+                    freeSlot(slot)
                     print("Erasing slot#: {}".format(slot))
                     return line
                 print("No active ICsound engine at slot#: {}".format(slot))
@@ -125,12 +124,36 @@ class CsoundMagics(Magics):
         #return line, cell
 
 
+import collections
 import ctypes
-import socket
+import hashlib
+import importlib
+import re
+import threading
+import time
 
-import ctcsound
-import numpy as np
-import matplotlib.pyplot as plt
+
+class _LazyModule:
+    """Stand-in for a heavy module, imported on first attribute access.
+
+    The module then replaces the stand-in in the module globals, so that
+    later accesses cost nothing. Loading the extension thus does not load
+    numpy or libcsound: ctcsound is imported when the first engine is
+    created, and matplotlib is only imported by plotTable.
+    """
+    def __init__(self, alias, name):
+        self._alias = alias
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+ctcsound = _LazyModule('ctcsound', 'ctcsound')
+np = _LazyModule('np', 'numpy')
+csoundSession = _LazyModule('csoundSession', 'csoundSession')
 
 def getCsound():
     if slots[0] is None:
@@ -138,25 +161,143 @@ def getCsound():
     return slots[0]
 
 
-def runCsd(csdName):
+class EnginePool:
+    """A pool of pre-created ctcsound.Csound engines rendering jobs concurrently.
+
+    The engines are created once, with a message buffer, and are configured
+    with the pool options. Jobs are run on a thread per engine, csound
+    performing without holding the GIL. Each job is compiled on an idle
+    engine and performed to its end, the engine being reset before it is
+    put back in the pool, so that no global state, output file or score time
+    is carried over from one job to the next. The orchestras that failed to
+    compile are remembered, so that their jobs fail without taking an engine.
+    """
+    def __init__(self, size=4, options=None):
+        self.size = size
+        self.options = list(options) if options else ['-d']
+        self._engines = collections.deque()
+        self._available = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._orcErrors = {}
+        for i in range(size):
+            cs = ctcsound.Csound()
+            cs.createMessageBuffer(0)
+            self._configure(cs)
+            self._engines.append(cs)
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+    def submitCsd(self, csd):
+        """Render a csd text on the next free engine, returning a Future."""
+        return self._executor.submit(self.renderCsd, csd)
+
+    def submitOrcSco(self, orc, sco):
+        """Render an orchestra and a score on the next free engine, returning a Future."""
+        return self._executor.submit(self.renderOrcSco, orc, sco)
+
+    def renderCsd(self, csd):
+        """Render a csd text and return 'OK' or 'Error'."""
+        key = self._key(csd)
+        if key in self._orcErrors:
+            print(self._orcErrors[key])
+            return 'Error'
+        cs = self._acquire()
+        try:
+            ret = cs.compileCsdText(csd)
+            if ret != ctcsound.CSOUND_SUCCESS:
+                self._orcErrors[key] = self._log(cs)
+                print(self._orcErrors[key])
+                return 'Error'
+            cs.start()
+            cs.perform()
+            return 'OK'
+        finally:
+            self._release(cs)
+
+    def renderOrcSco(self, orc, sco):
+        """Render an orchestra and a score and return the status as a string."""
+        key = self._key(orc)
+        if key in self._orcErrors:
+            print(self._orcErrors[key])
+            return 'Error in orchestra'
+        cs = self._acquire()
+        try:
+            ret = cs.compileOrc(orc)
+            if ret != ctcsound.CSOUND_SUCCESS:
+                self._orcErrors[key] = self._log(cs)
+                print(self._orcErrors[key])
+                return 'Error in orchestra'
+            ret = cs.readScore(sco)
+            if ret != ctcsound.CSOUND_SUCCESS:
+                print(self._log(cs))
+                return 'Error in score'
+            cs.start()
+            cs.perform()
+            return 'OK'
+        finally:
+            self._release(cs)
+
+    def shutdown(self):
+        """Wait for the running jobs and release the engines."""
+        self._executor.shutdown(wait=True)
+        self._engines.clear()
+
+    def _key(self, text):
+        h = hashlib.sha1(text.encode('utf-8'))
+        h.update('\0'.join(self.options).encode('utf-8'))
+        return h.hexdigest()
+
+    def _configure(self, cs):
+        for opt in self.options:
+            cs.setOption(opt)
+
+    def _acquire(self):
+        self._available.acquire()
+        with self._lock:
+            return self._engines.popleft()
+
+    def _release(self, cs):
+        self._log(cs)
+        cs.reset()
+        self._configure(cs)
+        with self._lock:
+            self._engines.append(cs)
+        self._available.release()
+
+    def _log(self, cs):
+        text = ''
+        while cs.messageCnt() > 0:
+            text += cs.firstMessage()
+            cs.popFirstMessage()
+        return text
+
+
+enginePool = None
+
+def getEnginePool(size=4, options=None):
+    """Return the engine pool used by runCsd and runOrcSco.
+
+    The pool is created on the first call, with size engines configured with
+    options.
+    """
+    global enginePool
+    if enginePool is None:
+        enginePool = EnginePool(size, options)
+    return enginePool
+
+
+def runCsd(csdName, wait=True):
     """Run a csd stored in the user namespace.
 
     One can store a csd in the user name space with the %%csd magic.
+    The csd is rendered on an engine of the engine pool. If wait is False,
+    a Future is returned at once, so that several runs can overlap.
     """
-    global slots, maxSlotNum
-    if slots[0] is None:
-        slots[0] = ctcsound.Csound()
-    cs = slots[0]
     ip = get_ipython()
     csd = ip.user_ns["__csd"][csdName]
-    ret = cs.compileCsdText(csd)
-    if ret == ctcsound.CSOUND_SUCCESS:
-        cs.start()
-        cs.perform()
-        cs.reset()
-        return 'OK'
-    else:
-        return 'Error'
+    if wait:
+        return getEnginePool().renderCsd(csd)
+    return getEnginePool().submitCsd(csd)
 
 
 def getCsd(csdName):
@@ -186,29 +327,19 @@ def getSco(scoName):
     return ip.user_ns["__sco"][scoName]
 
 
-def runOrcSco(orcName, scoName):
+def runOrcSco(orcName, scoName, wait=True):
     """Run an orchestra and score stored in the user namespace.
 
     One can store an orchestra in the user namespace with the %%orc magic, and
-    a score with the %%sco magic as well.
+    a score with the %%sco magic as well. The job is rendered on an engine
+    of the engine pool. If wait is False, a Future is returned at once.
     """
-    global slots, maxSlotNum
-    if slots[0] is None:
-        slots[0] = ctcsound.Csound()
-    cs = slots[0]
     ip = get_ipython()
     orc = ip.user_ns["__orc"][orcName]
-    ret = cs.compileOrc(orc)
-    if ret != ctcsound.CSOUND_SUCCESS:
-        return 'Error in orchestra'
     sco = ip.user_ns["__sco"][scoName]
-    ret = cs.readScore(sco)
-    if ret != ctcsound.CSOUND_SUCCESS:
-        return 'Error in score'
-    cs.start()
-    cs.perform()
-    cs.reset()
-    return 'OK'
+    if wait:
+        return getEnginePool().renderOrcSco(orc, sco)
+    return getEnginePool().submitOrcSco(orc, sco)
 
 
 class SlotError(Exception):
@@ -219,41 +350,634 @@ class SlotError(Exception):
         return repr(self.value)
 
 
-class ICsound(ctcsound.Csound):
+class ChannelBank:
+    """A bank of control channels read and written as one ndarray.
+
+    The bank is built from a list of channel names. The channels are created
+    if they don't exist yet. When the channel pointers are all MYFLT aligned
+    with each other, which is the case with csound's allocator, a single
+    ndarray view spanning them is used with an index array, so that a whole
+    bank is gathered or scattered in one vectorized operation. Otherwise, the
+    per-channel views returned by channelPtr are used. A bank is valid
+    until the engine it was built on is reset.
+    """
+    def __init__(self, cs, names):
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self._views = csoundSession.channelViews(cs, self.names)
+        self._values = np.zeros(len(self.names), dtype=ctcsound.MYFLT)
+        self._base, self._offsets = csoundSession.channelSpan(self._views)
+
+    def __len__(self):
+        return len(self.names)
+
+    def read(self, out=None):
+        """Return the current values of all the channels of the bank.
+
+        If out is given, the values are written into it instead of into the
+        internal buffer of the bank.
+        """
+        if out is None:
+            out = self._values
+        if self._base is not None:
+            np.take(self._base, self._offsets, out=out)
+        else:
+            for i, view in enumerate(self._views):
+                out[i] = view[0]
+        return out
+
+    def write(self, values):
+        """Set all the channels of the bank from a sequence of values."""
+        values = np.asarray(values, dtype=ctcsound.MYFLT)
+        if values.shape != (len(self.names),):
+            raise ValueError("Expected {} values".format(len(self.names)))
+        if self._base is not None:
+            self._base[self._offsets] = values
+        else:
+            for view, value in zip(self._views, values):
+                view[0] = value
+
+    def __getitem__(self, name):
+        return self._views[self.index[name]][0]
+
+    def __setitem__(self, name, value):
+        self._views[self.index[name]][0] = value
+
+
+class ClientTransport:
+    """A persistent UDP transport to a csound server.
+
+    Score lines and orchestra code are queued and packed into datagrams of
+    at most maxDatagram bytes, preserving their order. Consecutive score
+    lines are merged into a single scoreline_i block. Pending data is sent
+    when a datagram is full, when flush is called, and every flushInterval
+    seconds by a background thread. With a flushInterval of 0, every call
+    is sent at once.
+    """
+    def __init__(self, addr='127.0.0.1', port=12894, maxDatagram=8192,
+                 flushInterval=0.005):
+        self.addr = addr
+        self.port = port
+        self.maxDatagram = maxDatagram
+        self.flushInterval = flushInterval
+        import socket
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._scoreLines = []
+        self._size = 0
+        self._closed = threading.Event()
+        self._flusher = None
+        if flushInterval > 0:
+            self._flusher = threading.Thread(target=self._flushLoop)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def sendScore(self, score):
+        """Queue score lines."""
+        lines = [line for line in score.splitlines() if line.strip()]
+        with self._lock:
+            for line in lines:
+                self._reserve(len(line), scoreLine=True)
+                self._scoreLines.append(line)
+        if self.flushInterval <= 0:
+            self.flush()
+
+    def sendCode(self, code):
+        """Queue orchestra code."""
+        if not code.endswith('\n'):
+            code += '\n'
+        with self._lock:
+            self._closeScore()
+            self._reserve(len(code))
+            self._pending.append(code)
+        if self.flushInterval <= 0:
+            self.flush()
+
+    def sendTable(self, num, arr):
+        """Create table num on the server and fill it with the values in arr.
+
+        The values are sent in chunks fitting in a datagram, with their
+        shortest exact decimal representation, and copied into the table
+        with copya2ftab.
+        """
+        values = [repr(v) for v in np.asarray(arr, dtype=float).tolist()]
+        values = [v[:-2] if v.endswith('.0') else v for v in values]
+        self.sendCode('gitemp ftgen {}, 0, {}, -2, 0'.format(num, len(values)))
+        head = 'iarr_[] fillarray '
+        limit = self.maxDatagram - 64
+        start = 0
+        while start < len(values):
+            end, size = start, len(head)
+            while end < len(values) and end - start < 1000 and size + len(values[end]) + 1 <= limit:
+                size += len(values[end]) + 1
+                end += 1
+            end = max(end, start + 1)
+            self.sendCode(head + ','.join(values[start:end]) +
+                          '\ncopya2ftab iarr_, {}, {}'.format(num, start))
+            start = end
+
+    def flush(self):
+        """Send all pending data."""
+        with self._lock:
+            self._sendPending()
+
+    def close(self):
+        """Flush pending data and close the socket."""
+        self._closed.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush()
+        self._sock.close()
+
+    def _reserve(self, size, scoreLine=False):
+        need = size + (self._scoreOverhead() if scoreLine else 0)
+        if self._size + need > self.maxDatagram:
+            self._sendPending()
+            need = size + (self._scoreOverhead() if scoreLine else 0)
+        self._size += need
+
+    def _scoreOverhead(self):
+        return 1 if self._scoreLines else len('scoreline_i {{}}\n')
+
+    def _sendPending(self):
+        self._closeScore()
+        if self._pending:
+            self._send(''.join(self._pending))
+            self._pending = []
+        self._size = 0
+
+    def _closeScore(self):
+        if self._scoreLines:
+            self._pending.append('scoreline_i {{' + '\n'.join(self._scoreLines) + '}}\n')
+            self._scoreLines = []
+
+    def _send(self, message):
+        self._sock.sendto(ctcsound.cstring(message), (self.addr, self.port))
+
+    def _flushLoop(self):
+        while not self._closed.wait(self.flushInterval):
+            self.flush()
+
+
+LogRecord = collections.namedtuple('LogRecord', 'time attr text')
+
+
+class MessageLog:
+    """A bounded log of the messages of a csound instance.
+
+    The messages are drained from the csound message buffer in batches by
+    a background thread every drainInterval seconds, or when drain is
+    called, and stored as LogRecord(time, attr, text) in a ring buffer
+    keeping the last maxRecords messages.
+    """
+    def __init__(self, cs, maxRecords=10000, drainInterval=0.1):
+        self.cs = cs
+        self.drainInterval = drainInterval
+        self._records = collections.deque(maxlen=maxRecords)
+        self._total = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._drainer = None
+
+    def start(self):
+        """Start the background drain thread."""
+        if self._drainer or self.drainInterval <= 0:
+            return
+        self._stopped.clear()
+        self._drainer = threading.Thread(target=self._drainLoop)
+        self._drainer.daemon = True
+        self._drainer.start()
+
+    def stop(self):
+        """Stop the background drain thread, draining pending messages."""
+        if self._drainer:
+            self._stopped.set()
+            self._drainer.join()
+            self._drainer = None
+        self.drain()
+
+    def drain(self):
+        """Move the pending messages of the csound message buffer into the log."""
+        cs = self.cs
+        with self._lock:
+            cnt = cs.messageCnt()
+            if cnt == 0:
+                return
+            now = time.time()
+            batch = []
+            for i in range(cnt):
+                batch.append(LogRecord(now, cs.firstMessageAttr(), cs.firstMessage()))
+                cs.popFirstMessage()
+            self._records.extend(batch)
+            self._total += cnt
+
+    def mark(self):
+        """Return a mark to be passed to since."""
+        with self._lock:
+            return self._total
+
+    def since(self, mark):
+        """Return the records logged after mark was taken, if still in the log."""
+        with self._lock:
+            n = min(self._total - mark, len(self._records))
+            return list(self._records)[len(self._records) - n:]
+
+    def tail(self, n=20, msgType=None):
+        """Return the last n records, optionally of one message type only."""
+        with self._lock:
+            records = list(self._records)
+        if msgType is not None:
+            records = [r for r in records if r.attr & ctcsound.CSOUNDMSG_TYPE_MASK == msgType]
+        return records[-n:] if n else records
+
+    def search(self, pattern, msgType=None):
+        """Return the records whose text matches the regular expression pattern."""
+        regex = re.compile(pattern)
+        return [r for r in self.tail(0, msgType) if regex.search(r.text)]
+
+    def text(self, records=None):
+        """Return the text of records, or of the whole log."""
+        if records is None:
+            records = self.tail(0)
+        return ''.join(r.text for r in records)
+
+    def clear(self):
+        """Delete all the records."""
+        with self._lock:
+            self._records.clear()
+
+    def __len__(self):
+        return len(self._records)
+
+    def _drainLoop(self):
+        while not self._stopped.wait(self.drainInterval):
+            self.drain()
+
+
+_blockStart = re.compile(r'^\s*(instr|opcode)\s+([^\s,]+(?:\s*,\s*[^\s,]+)*)')
+_blockEnd = re.compile(r'^\s*(endin|endop)\b')
+_commentMark = re.compile(r'/\*|//|;')
+
+def _stripComments(line, inComment):
+    """Return the code of line outside comments, and whether a /* */ comment
+    is still open at its end"""
+    code = ''
+    while line:
+        if inComment:
+            end = line.find('*/')
+            if end < 0:
+                return code, True
+            line = line[end + 2:]
+            inComment = False
+        else:
+            m = _commentMark.search(line)
+            if not m:
+                return code + line, False
+            code += line[:m.start()]
+            if m.group() != '/*':
+                return code, False
+            code += ' '
+            line = line[m.end():]
+            inComment = True
+    return code, inComment
+
+def splitOrc(code):
+    """Split orchestra code into a list of (key, text) blocks.
+
+    Instrument and UDO definitions are keyed by 'instr <names>' and
+    'opcode <name>'. The global code between them makes blocks keyed by
+    'global'. Blank global blocks are dropped. Comments are kept in the
+    blocks but are not searched for block boundaries.
+    """
+    blocks = []
+    lines = []
+    key = None
+    inComment = False
+    for line in code.splitlines(True):
+        stripped, inComment = _stripComments(line, inComment)
+        m = _blockStart.match(stripped)
+        if key is None and m:
+            if ''.join(lines).strip():
+                blocks.append(('global', ''.join(lines)))
+            lines = []
+            name = m.group(2) if m.group(1) == 'instr' else m.group(2).split(',')[0]
+            key = '{} {}'.format(m.group(1), re.sub(r'\s+', '', name))
+        lines.append(line)
+        if key is not None and _blockEnd.match(stripped):
+            blocks.append((key, ''.join(lines)))
+            lines = []
+            key = None
+    if ''.join(lines).strip():
+        blocks.append((key or 'global', ''.join(lines)))
+    return blocks
+
+
+freeSlots = collections.deque(range(1, maxSlotNum + 1))
+_slotLock = threading.Lock()
+
+def setMaxSlotNum(num):
+    """Raise the number of slots available for ICsound engines."""
+    global slots, maxSlotNum
+    with _slotLock:
+        if num > maxSlotNum:
+            slots.extend([None] * (num - maxSlotNum))
+            freeSlots.extend(range(maxSlotNum + 1, num + 1))
+            maxSlotNum = num
+
+
+def allocSlot(engine):
+    """Bind engine to a free slot in O(1) and return the slot number."""
+    with _slotLock:
+        if not freeSlots:
+            raise SlotError("No more slot available for this engine")
+        num = freeSlots.popleft()
+        slots[num] = engine
+        return num
+
+
+def freeSlot(num):
+    """Release slot#num."""
+    with _slotLock:
+        if slots[num] is not None:
+            slots[num] = None
+            if num > 0:
+                freeSlots.append(num)
+
+
+class MultiplexedPerformance:
+    """The performance of an engine run by an EngineDriver.
+
+    It has the interface of ctcsound.CsoundPerformanceThread used by ICsound.
+    Events and messages are passed with the asynchronous csound API
+    functions, so they are consumed by the driver at the next k-cycle.
+    If messageLog is set, it is drained by the driver while the engine is
+    playing, instead of by a thread of its own.
+    """
+    def __init__(self, driver, cs):
+        self.driver = driver
+        self.cs = cs
+        self.period = cs.ksmps() / cs.sr()
+        self.due = 0.0
+        self.messageLog = None
+        self._drainDue = 0.0
+        self._playing = False
+        self._stopRequested = False
+        self._status = 0
+        self._done = threading.Event()
+        self.processCallback = None
+
+    def isRunning(self):
+        return self._playing and not self._done.is_set()
+
+    def status(self):
+        return self._status
+
+    def play(self):
+        if not self._playing:
+            self.due = time.time()
+        self._playing = True
+        self.driver._notify()
+
+    def pause(self):
+        self._playing = False
+
+    def togglePause(self):
+        if self._playing:
+            self.pause()
+        else:
+            self.play()
+
+    def stop(self):
+        self._stopRequested = True
+        self.driver._notify()
+
+    def join(self):
+        self._done.wait()
+        return self._status
+
+    def inputMessage(self, s):
+        self.cs.inputMessageAsync(s)
+
+    def scoreEvent(self, absp2mode, opcod, pFields):
+        if absp2mode:
+            self.cs.scoreEventAbsoluteAsync(opcod, pFields, 0)
+        else:
+            self.cs.scoreEventAsync(opcod, pFields)
+
+    def flushMessageQueue(self):
+        pass
+
+    def record(self, filename, samplebits, numbufs):
+        print("Recording is not supported for multiplexed engines")
+
+    def stopRecord(self):
+        print("Recording is not supported for multiplexed engines")
+
+    def _cycle(self):
+        """Perform one k-cycle, return False when the performance is over."""
+        if self._stopRequested:
+            return self._finish(1)
+        if not self._playing:
+            return True
+        if self.processCallback:
+            self.processCallback()
+        ret = self.cs.performKsmps()
+        self.due += self.period
+        if ret != 0:
+            return self._finish(ret)
+        return True
+
+    def _finish(self, status):
+        self._status = status
+        self.cs.cleanup()
+        self._done.set()
+        return False
+
+
+class EngineDriver:
+    """Run the performances of many engines on a small fixed pool of threads.
+
+    Each engine attached to the driver is assigned to the least loaded
+    thread. Each thread performs one k-cycle of every engine that is due
+    in turn, round-robin, an engine being due when its performance time is
+    less than lookahead seconds ahead of the wall clock. Engines writing to
+    an audio device are also paced by their blocking audio output. A thread
+    with no engine playing sleeps until an engine is played or stopped.
+    """
+    def __init__(self, numThreads=2, lookahead=0.05):
+        self.lookahead = lookahead
+        self._lanes = [[] for i in range(numThreads)]
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._threads = []
+        for i in range(numThreads):
+            t = threading.Thread(target=self._run, args=(i,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def attach(self, cs):
+        """Return a paused MultiplexedPerformance of cs run by this driver."""
+        perf = MultiplexedPerformance(self, cs)
+        with self._lock:
+            lane = min(range(len(self._lanes)), key=lambda i: len(self._lanes[i]))
+            self._lanes[lane] = self._lanes[lane] + [perf]
+        return perf
+
+    def engineCount(self):
+        """Return the number of engines attached to the driver."""
+        return sum(len(lane) for lane in self._lanes)
+
+    def shutdown(self):
+        """Stop all the performances and the driver threads."""
+        for lane in self._lanes:
+            for perf in lane:
+                perf.stop()
+        self._stopped.set()
+        self._notify()
+        for t in self._threads:
+            t.join()
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def _detach(self, lane, perf):
+        with self._lock:
+            self._lanes[lane] = [p for p in self._lanes[lane] if p is not perf]
+
+    def _idle(self, lane):
+        return not any(perf._playing or perf._stopRequested
+                       for perf in self._lanes[lane])
+
+    def _run(self, lane):
+        while not self._stopped.is_set():
+            now = time.time()
+            wake = None
+            for perf in self._lanes[lane]:
+                if perf.due < now - 1.0:
+                    perf.due = now
+                if perf.due <= now + self.lookahead or perf._stopRequested:
+                    if not perf._cycle():
+                        self._detach(lane, perf)
+                        continue
+                if not perf._playing:
+                    continue
+                due = perf.due - self.lookahead
+                log = perf.messageLog
+                if log and log.drainInterval > 0:
+                    if perf._drainDue <= now:
+                        log.drain()
+                        perf._drainDue = now + log.drainInterval
+                    due = min(due, perf._drainDue)
+                wake = due if wake is None else min(wake, due)
+            with self._changed:
+                if wake is None:
+                    while self._idle(lane) and not self._stopped.is_set():
+                        self._changed.wait()
+                else:
+                    delay = wake - time.time()
+                    if delay > 0:
+                        self._changed.wait(delay)
+        for perf in self._lanes[lane]:
+            perf._finish(1)
+        self._lanes[lane] = []
+
+
+engineDriver = None
+
+def getEngineDriver(numThreads=2):
+    """Return the engine driver shared by the multiplexed ICsound engines.
+
+    The driver is created on the first call with numThreads threads.
+    """
+    global engineDriver
+    if engineDriver is None:
+        engineDriver = EngineDriver(numThreads)
+    return engineDriver
+
+
+_icsoundClass = None
+
+def icsoundClass():
+    """Return the ICsound class, creating it on the first call.
+
+    ICsound derives from ctcsound.Csound and from _ICsound, which holds
+    its methods. It is created on demand, so that libcsound is not loaded
+    with the extension.
+    """
+    global _icsoundClass
+    if _icsoundClass is None:
+        _icsoundClass = type('ICsound', (_ICsound, ctcsound.Csound),
+                             {'__doc__': _ICsound.__doc__, '__module__': __name__})
+    return _icsoundClass
+
+
+def __getattr__(name):
+    if name == 'ICsound':
+        return icsoundClass()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class _LazyClass:
+    """Stand-in for a class in the user namespace, created on first use."""
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __call__(self, *args, **kwargs):
+        return self._factory()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._factory(), attr)
+
+    def __instancecheck__(self, obj):
+        return isinstance(obj, self._factory())
+
+
+class _ICsound:
     """Implement Andrés Cabrera's icsound module in csoundmagics.
 
     An ICsound object is a child of a ctcsound.Csound object. It is bound
     to a slot number. This slot number can be used to specify this ICsound
     object when calling a %csound or a %%csound magic command.
+
+    If multiplexed is True, the engine is performed by the shared
+    EngineDriver instead of by its own CsoundPerformanceThread.
     """
     def __init__(self, sr=44100, ksmps=32, nchnls=2, zerodbfs=1.0, dac='dac',
-                 adc='', port=0, bufferSize=0):
+                 adc='', port=0, bufferSize=0, logSize=10000, multiplexed=False):
         """Create an instance of ICsound."""
-        global slots, maxSlotNum
         self.slotNum = 0
-        for i in range(maxSlotNum):
-            if not slots[i + 1]:
-                self.slotNum = i + 1
-                break
-        if self.slotNum == 0:
-            raise SlotError("No more slot available for this engine")
-        ctcsound.Csound.__init__(self)
+        self._client = None
         self._csPerf = None
+        self.slotNum = allocSlot(self)
+        ctcsound.Csound.__init__(self)
+        self._driver = getEngineDriver() if multiplexed else None
         self._prevMsgNewLine = True
-        self._log = ''
+        self.messageLog = None
         self._verbose = False
         self._myfltSize = self.sizeOfMYFLT()
         self._clientAddr = None
         self._clientPort = None
-        slots[self.slotNum] = self
-        self.startEngine(sr, ksmps, nchnls, zerodbfs, dac, adc, port, bufferSize)
+        self.incrementalCode = False
+        self.meter = None
+        self._meterTap = None
+        self._kcycleHooks = []
+        self._hooksInstalled = False
+        self._envelopes = {}
+        self.tracer = None
+        self.startEngine(sr, ksmps, nchnls, zerodbfs, dac, adc, port, bufferSize, logSize)
 
     def __del__(self):
         global slots, maxSlotNum
+        if self._client:
+            self._client.close()
         if self._csPerf:
             self.stopEngine(reset=False)
-        if slots[self.slotNum]:
-            slots[self.slotNum] = None
+        if self.slotNum and slots[self.slotNum] is self:
+            freeSlot(self.slotNum)
 
     def listInterfaces(self, output=True):
         """List the audio devices available on the system."""
@@ -263,27 +987,37 @@ class ICsound(ctcsound.Csound):
             print("{:2d}: {}".format(i, dev))
             i += 1
 
-    def startClient(self, addr='127.0.0.1', port=12894):
+    def startClient(self, addr='127.0.0.1', port=12894, maxDatagram=8192,
+                    flushInterval=0.005):
         """Start the client feature of this engine.
         
         sendScore and sendCode method will send their data to the
-        IP address and port specified.
+        IP address and port specified, through a ClientTransport packing
+        them into datagrams of at most maxDatagram bytes, sent at least
+        every flushInterval seconds.
         """
+        if self._client:
+            self._client.close()
         self._clientAddr = addr
         self._clientPort = port
+        self._client = ClientTransport(addr, port, maxDatagram, flushInterval)
+        self._blockHashes = {}
 
     def startEngine(self, sr=44100, ksmps=32, nchnls=2, zerodbfs=1.0, dac='dac',
-                    adc='', port=0, bufferSize=0):
+                    adc='', port=0, bufferSize=0, logSize=10000):
         """Start an ICsound engine.
         
         The user can specify values for sr, ksmps, nchnls, zerodbfs, dac, adc,
         a port number, and the messages buffer size. If a port number is given,
         this engine will listen to that port for csound code and events.
+        The last logSize messages are kept in the messageLog of the engine.
         """
         if self._csPerf:
             print("CsoundMagics: Csound already running")
             return
         if self._clientAddr or self._clientPort:
+            self._client.close()
+            self._client = None
             self._clientAddr = None
             self._clientPort = None
             self._debugPrint("Closing existing client connection before starting engine")
@@ -294,6 +1028,8 @@ class ICsound(ctcsound.Csound):
         self._dac = dac
         self._adc = adc
         self.createMessageBuffer(0)
+        self.messageLog = MessageLog(self, logSize)
+        self._blockHashes = {}
         self.setOption('-o' + self._dac)
         self._bufferSize = bufferSize
         if self._adc:
@@ -311,9 +1047,17 @@ class ICsound(ctcsound.Csound):
         '''.format(self._sr, self._ksmps, self._nchnls, self._0dbfs)
         self.compileOrc(orc)
         self.start()
-        self._csPerf = ctcsound.CsoundPerformanceThread(self.csound())
+        if self._driver:
+            self._csPerf = self._driver.attach(self)
+        else:
+            self._csPerf = ctcsound.CsoundPerformanceThread(self.csound())
+        self._hooksInstalled = False
+        self._installKcycleHooks()
+        if self._driver:
+            self._csPerf.messageLog = self.messageLog
+        else:
+            self.messageLog.start()
         self._csPerf.play()
-        self._flushMessages()
         if self._csPerf.status() == 0:
             print("Csound engine started at slot#: {}.".format(self.slotNum))
             if port > 0:
@@ -334,7 +1078,12 @@ class ICsound(ctcsound.Csound):
             self._csPerf.stop()
         self._csPerf.join()
         self._csPerf = None
-        self.clearLog()
+        self._hooksInstalled = False
+        self.stopMeter()
+        self.stopTracing()
+        self._envelopes = {}
+        self.messageLog.stop()
+        self.messageLog = None
         self.destroyMessageBuffer()
         if reset:
             self.reset()
@@ -346,38 +1095,72 @@ class ICsound(ctcsound.Csound):
         
         If the startClient method had been called previously, the events
         will be sent to a server as UDP packets instead.
+
+        While tracing (see startTracing), the latency of the i statements
+        is traced.
         """
         if self._clientAddr:
-            self._sendToServer('scoreline_i {{' + score + '}}\n')
+            self._client.sendScore(score)
             return
+        if self.tracer:
+            score = self.tracer.traceScore(score)
         self._csPerf.inputMessage(score)
         self._flushMessages()
 
-    def sendCode(self, code):
+    def sendCode(self, code, incremental=None):
         """Send orchestra code to the engine.
         
         If the startClient method had been called previously, the code
         will be sent to a server as UDP packets instead.
+
+        If incremental is True, or if it is None and the incrementalCode
+        attribute is True, the code is split into instrument, UDO and
+        global blocks, and only the blocks that changed since they were
+        last compiled on this engine are sent. Global blocks are skipped
+        when the same text was already compiled. The keys of the skipped
+        blocks are printed and returned.
         """
+        if incremental is None:
+            incremental = self.incrementalCode
+        skipped = []
+        if incremental:
+            changed = []
+            hashes = {}
+            for key, text in splitOrc(code):
+                h = hashlib.sha1(text.rstrip().encode('utf-8')).hexdigest()
+                hkey = (key, h) if key == 'global' else key
+                if self._blockHashes.get(hkey) == h:
+                    skipped.append(key)
+                else:
+                    changed.append(text)
+                    hashes[hkey] = h
+            if skipped:
+                print("Skipped unchanged blocks: {}".format(', '.join(skipped)))
+            if not changed:
+                return skipped
+            code = ''.join(changed)
         if self._clientAddr:
-            self._sendToServer(code)
-            return
+            self._client.sendCode(code)
+            if incremental:
+                self._blockHashes.update(hashes)
+            return skipped
         self._flushMessages()
+        mark = self.messageLog.mark()
         ret = self.compileOrc(code)
-        errorText = ''
-        for i in range(self.messageCnt()):
-            self._log += self.firstMessage()
-            errorText += self.firstMessage()
-            self.popFirstMessage()
+        self._flushMessages()
         if ret:
-            print(errorText)
+            print(self.messageLog.text(self.messageLog.since(mark)))
+        elif incremental:
+            self._blockHashes.update(hashes)
+        return skipped
 
     def makeTable(self, num, size, gen, *args):
         """Create a function table for this engine."""
         data = 'gitemp_ ftgen {}, 0, {}, {}, '.format(num, size, gen)
         data += ', '.join(map(str, list(args)))
         self._debugPrint(data)
-        self.sendCode(data)
+        self._envelopes.pop(num, None)
+        self.sendCode(data, incremental=False)
 
     def fillTable(self, num, arr):
         """Fill a table with GEN2 using the data in arr.
@@ -391,9 +1174,7 @@ class ICsound(ctcsound.Csound):
             raise TypeError("Only one dimensional arrays are valid")
         
         if self._clientAddr:
-            data = ', '.join(map(str, arr))
-            data = 'gitemp ftgen {}, 0, {}, -2, '.format(num, len(arr)) + data
-            self.sendCode(data)
+            self._client.sendTable(num, arr)
             return
 
         p = np.array(arr).astype(ctcsound.MYFLT)
@@ -410,28 +1191,203 @@ class ICsound(ctcsound.Csound):
         src = p.ctypes.data_as(ctypes.POINTER(ctcsound.MYFLT))
         dest = table.ctypes.data_as(ctypes.POINTER(ctcsound.MYFLT))
         ctypes.memmove(dest, src, p.size * self._myfltSize)
+        self._envelopes.pop(num, None)
 
-    def plotTable(self, num, reuse=False):
-        """Plot a table using matplotlib with predefined styles."""
+    def addKcycleHook(self, hook):
+        """Call hook() before each k-cycle of the engine.
+        
+        All the hooks share a single process callback of the performance
+        thread, or of the multiplexed performance, so that the meter, the
+        tracer and other hooks can run together. The hooks run in the
+        performance thread and must return quickly.
+        """
+        self._kcycleHooks = self._kcycleHooks + [hook]
+        self._installKcycleHooks()
+
+    def removeKcycleHook(self, hook):
+        """Remove a hook added with addKcycleHook."""
+        self._kcycleHooks = [h for h in self._kcycleHooks if h != hook]
+
+    def _installKcycleHooks(self):
+        if self._csPerf and self._kcycleHooks and not self._hooksInstalled:
+            if isinstance(self._csPerf, MultiplexedPerformance):
+                self._csPerf.processCallback = self._runKcycleHooks
+            else:
+                csoundSession.setProcessCallback(self._csPerf, self._runKcycleHooks)
+            self._hooksInstalled = True
+
+    def _runKcycleHooks(self):
+        for hook in self._kcycleHooks:
+            hook()
+
+    def startMeter(self, **options):
+        """Meter the output of the running engine.
+        
+        Before each k-cycle, the output of the previous one (spout) is copied
+        into the queue of a csoundSession.OutputMeter, whose worker thread
+        computes the levels and spectra. The options are passed to
+        OutputMeter. Return the started meter.
+        """
+        if not self._csPerf or self._clientAddr:
+            print("Engine is not running")
+            return
+        self.stopMeter()
+        meter = csoundSession.OutputMeter(sr=self.sr(), **options)
+        meter.start()
+        self._meterTap = self.spout().reshape(-1, self.nchnls())
+        self.meter = meter
+        self.addKcycleHook(self._meterCycle)
+        return meter
+
+    def stopMeter(self):
+        """Stop metering the output, returning the OutputMeter."""
+        meter, self.meter = self.meter, None
+        if not meter:
+            return None
+        self.removeKcycleHook(self._meterCycle)
+        meter.stop()
+        return meter
+
+    def _meterCycle(self):
+        meter = self.meter
+        if meter is not None:
+            meter.push(self._meterTap)
+
+    def startTracing(self, capacity=4096, instrNum=9999):
+        """Trace the latency of the score events sent with sendScore.
+        
+        A csoundSession.EventTracer is attached to the engine as a k-cycle
+        hook, with its performance thread or multiplexed. Return the
+        tracer.
+        """
+        if not self._csPerf or self._clientAddr:
+            print("Engine is not running")
+            return
+        self.stopTracing()
+        tracer = csoundSession.EventTracer(self, capacity, instrNum)
+        tracer.attach(self)
+        self.tracer = tracer
+        return tracer
+
+    def stopTracing(self):
+        """Stop tracing the score events, returning the EventTracer."""
+        tracer, self.tracer = self.tracer, None
+        if tracer:
+            tracer.detach()
+        return tracer
+
+    def snapshotTables(self, fileName, tables=None, maxNum=10000):
+        """Save function tables into an archive file.
+        
+        tables is a list of table numbers, by default all the tables numbered
+        from 1 to maxNum. The archive is written by csoundSession.saveTables.
+        Return the list of the saved table numbers.
+        """
+        if self._clientAddr:
+            print("Operation not supported for client interface")
+            return
+        return csoundSession.saveTables(self, fileName, tables, maxNum)
+
+    def restoreTables(self, fileName, tables=None):
+        """Load function tables saved by snapshotTables into the engine.
+        
+        tables is a list of the table numbers to load, by default all the
+        tables of the archive. The archive is read by
+        csoundSession.loadTables, the missing tables being created with
+        sendCode. Return the list of the loaded table numbers.
+        """
+        if self._clientAddr:
+            print("Operation not supported for client interface")
+            return
+        loaded = csoundSession.loadTables(
+            self, fileName, tables, lambda code: self.sendCode(code, incremental=False))
+        for num in loaded:
+            self._envelopes.pop(num, None)
+        return loaded
+
+    def tableEnvelope(self, num, width=1000, start=0, end=None):
+        """Return the min/max envelope of a table range as (x, low, high).
+        
+        The range [start, end) is cut into width bins, x holding the first
+        index of each bin and low and high the minimum and maximum of the
+        bin, so that a plot width pixels wide shows every peak. Ranges of
+        less than 2 * width points are returned undecimated, low and high
+        being the points themselves. The envelopes are cached per table and
+        range. The cache of a table is dropped when the table is written by
+        makeTable, fillTable or restoreTables, and when its size or its
+        address changed. After writing into a table otherwise (e.g. through
+        the array returned by table, or with tablew), call invalidateTable.
+        """
+        table = self.table(num)
+        if table is None:
+            return None
+        size = table.size
+        start = min(max(start, 0), size)
+        end = size if end is None else min(max(end, start), size)
+        signature = (size, table.ctypes.data)
+        cached = self._envelopes.get(num)
+        if cached is None or cached[0] != signature:
+            cached = self._envelopes[num] = (signature, collections.OrderedDict())
+        ranges = cached[1]
+        key = (start, end, width)
+        if key in ranges:
+            ranges.move_to_end(key)
+            return ranges[key]
+        data = table[start:end]
+        if len(data) < 2 * width:
+            points = data.copy()
+            envelope = (np.arange(start, end), points, points)
+        else:
+            edges = (np.arange(width) * len(data)) // width
+            envelope = (start + edges, np.minimum.reduceat(data, edges),
+                        np.maximum.reduceat(data, edges))
+        ranges[key] = envelope
+        if len(ranges) > 16:
+            ranges.popitem(last=False)
+        return envelope
+
+    def invalidateTable(self, num=None):
+        """Drop the cached envelopes of table num, or of all the tables."""
+        if num is None:
+            self._envelopes = {}
+        else:
+            self._envelopes.pop(num, None)
+
+    def plotTable(self, num, reuse=False, start=0, end=None, width=None):
+        """Plot a table using matplotlib with predefined styles.
+        
+        Only the range [start, end) of the table is plotted, the whole table
+        by default. Large ranges are drawn as their min/max envelope (see
+        tableEnvelope), one bin per pixel of the axes unless width is given.
+        """
+        import matplotlib.pyplot as plt
         if self._clientAddr:
             print("Operation not supported for client interface")
             return
         if isinstance(num, str):
             num = int(self.evalCode('return %s' % (num)))
-        table = self.table(num)
         if not reuse:
             fix, ax = plt.subplots(figsize=(10, 6))
         else:
             ax = plt.gca()
-        ax.hlines(0, 0, table.size)
+        if width is None:
+            width = max(int(ax.get_window_extent().width), 100)
+        size = self.tableLength(num)
+        start = min(max(start, 0), size)
+        end = size if end is None else min(max(end, start), size)
+        x, low, high = self.tableEnvelope(num, width, start, end)
+        ax.hlines(0, start, end)
         ax.spines['top'].set_visible(False)
         ax.spines['right'].set_visible(False)
         ax.spines['bottom'].set_visible(False)
-        ax.set_xticks(range(0, table.size + 1, int(table.size / 4)))
+        ax.set_xticks(range(start, end + 1, max(int((end - start) / 4), 1)))
         ax.xaxis.set_ticks_position('bottom')
         ax.yaxis.set_ticks_position('left')
-        ax.plot(table, color='black', lw=2)
-        plt.xlim(0, table.size)
+        if low is high:
+            ax.plot(x, low, color='black', lw=2)
+        else:
+            ax.fill_between(x, low, high, color='black', lw=1, step='post')
+        plt.xlim(start, end)
 
     def setChannel(self, name, value):
         """Set a value on a control channel."""
@@ -447,6 +1403,13 @@ class ICsound(ctcsound.Csound):
             return
         return self.controlChannel(name)
 
+    def channelBank(self, names):
+        """Return a ChannelBank over the control channels listed in names."""
+        if self._clientAddr:
+            print("Operation not supported for client interface")
+            return
+        return ChannelBank(self, names)
+
     def startRecord(self, fileName, sampleBits=16, numBufs=4):
         """Start recording the audio output in an audio file."""
         if self._clientAddr:
@@ -461,32 +1424,42 @@ class ICsound(ctcsound.Csound):
             return
         return self._csPerf.stopRecord()
 
-    def printLog(self):
-        """Display the messages in the csound message buffer."""
+    def printLog(self, n=0, msgType=None, pattern=None):
+        """Display the messages in the csound message buffer.
+
+        If n is given, only the last n messages are displayed. The messages
+        can be restricted to one message type (e.g. ctcsound.CSOUNDMSG_ERROR)
+        and to those matching the regular expression pattern.
+        """
         self._flushMessages()
         if self._clientAddr:
             print("Operation not supported for client interface")
             return
-        print(self._log)
+        if not self.messageLog:
+            print("Engine is not running")
+            return
+        if pattern:
+            records = self.messageLog.search(pattern, msgType)
+        else:
+            records = self.messageLog.tail(0, msgType)
+        if n:
+            records = records[-n:]
+        print(self.messageLog.text(records))
 
     def clearLog(self):
         """Delete the messages in the csound message buffer."""
         self._flushMessages()
-        self._log = ''
+        if self.messageLog:
+            self.messageLog.clear()
 
     def _flushMessages(self):
-        for i in range(self.messageCnt()):
-            self._log += self.firstMessage()
-            self.popFirstMessage()
+        if self.messageLog:
+            self.messageLog.drain()
 
     def _debugPrint(self, *text):
         if self._verbose:
             print(text)
 
-    def _sendToServer(self, message):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-        sock.sendto(ctcsound.cstring(message), (self._clientAddr, self._clientPort))
-
 
 def load_ipython_extension(ip):
     ip.magics_manager.register(CsoundMagics)
@@ -496,4 +1469,7 @@ def load_ipython_extension(ip):
     ip.user_ns['getOrc'] = getOrc
     ip.user_ns['getSco'] = getSco
     ip.user_ns['runOrcSco'] = runOrcSco
-    ip.user_ns['ICsound'] = ICsound
+    ip.user_ns['getEnginePool'] = getEnginePool
+    ip.user_ns['ICsound'] = _LazyClass(icsoundClass)
+    ip.user_ns['ChannelBank'] = ChannelBank
+    ip.user_ns['setMaxSlotNum'] = setMaxSlotNum
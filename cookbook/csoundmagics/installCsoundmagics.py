@@ -9,9 +9,10 @@ import site
 
 import notebook
 
-# Copy csoundmagics in site-packages dir
+# Copy csoundmagics and csoundSession in site-packages dir
 dest = site.getsitepackages()[0]
 shutil.copy("csoundmagics.py", dest)
+shutil.copy(os.path.join("..", "..", "csoundSession.py"), dest)
 
 # Copy csound mode in codemirror
 dest = os.path.join(dest, "nbclassic", "static", "components", "codemirror", "mode", "csound")
@@ -16,9 +16,10 @@ def copy_file(filename, dest):
     except PermissionError:
         os.system('sudo cp "{}" "{}"'.format(filename, dest))
 
-# Copy csoundmagics in site-packages dir
+# Copy csoundmagics and csoundSession in site-packages dir
 dest = site.getsitepackages()[0]
 copy_file("csoundmagics.py", dest)
+copy_file(os.path.join("..", "..", "csoundSession.py"), dest)
 
 # Copy csound mode in codemirror
 dest = nbclassic.__path__[0]
@@ -21,9 +21,82 @@
 #
 
 import os
+import collections
 import ctypes
+import json
+import multiprocessing
+import re
+import struct
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
 import ctcsound
 
+# CsoundPTscoreEvent with a plain address for the pfields, so that the rows
+# of an array can be sent without building a ctypes pointer for each of them
+_ptScoreEvent = None
+
+def setProcessCallback(pt, function):
+    """Make a performance thread call function() before each k-cycle
+
+    Unlike CsoundPerformanceThread.setProcessCB, the ctypes callback is kept
+    alive as long as the performance thread object, so that it is never
+    freed while the performance thread may still call it. If function is
+    None, the callback is removed.
+    """
+    if function is None:
+        cb = ctcsound.PROCESSFUNC()
+    else:
+        cb = ctcsound.PROCESSFUNC(lambda data: function())
+    if not hasattr(pt, '_processCallbacks'):
+        pt._processCallbacks = []
+    pt._processCallbacks.append(cb)
+    ctcsound.libcspt.CsoundPTsetProcessCB(pt.cpt, cb, None)
+
+
+_controlChannel = (ctcsound.CSOUND_CONTROL_CHANNEL | ctcsound.CSOUND_INPUT_CHANNEL |
+                   ctcsound.CSOUND_OUTPUT_CHANNEL)
+
+def channelViews(cs, names):
+    """Return the one-value views of the control channels names of cs
+
+    The channels are created as input and output channels if they don't
+    exist yet. Raise ValueError if a channel cannot be created.
+    """
+    views = []
+    for name in names:
+        view, err = cs.channelPtr(name, _controlChannel)
+        if view is None:
+            raise ValueError("Channel {}: {}".format(name, err))
+        views.append(view)
+    return views
+
+
+def channelSpan(views):
+    """Return (span, index), span being a MYFLT array over all the channel
+    views and index the position of each view in span
+
+    With csound's allocator, the channels are MYFLT aligned with each
+    other, so that a whole set of channels is gathered or scattered in one
+    vectorized operation on span. Return (None, None) if they are not.
+    """
+    if not views:
+        return None, None
+    itemSize = ctypes.sizeof(ctcsound.MYFLT)
+    addrs = np.array([v.ctypes.data for v in views], dtype=np.uint64)
+    base = int(addrs.min())
+    offsets = addrs - base
+    if not np.all(offsets % itemSize == 0):
+        return None, None
+    span = np.ctypeslib.as_array(
+        (ctcsound.MYFLT * (int(offsets.max()) // itemSize + 1)).from_address(base))
+    return span, (offsets // itemSize).astype(np.intp)
+
+
 class CsoundSession(ctcsound.Csound):
     """A class for running a csound session"""
 
@@ -31,6 +104,20 @@ class CsoundSession(ctcsound.Csound):
         """Start a csound session, eventually loading a csd file"""
         ctcsound.Csound.__init__(self)
         self.pt = None
+        self.tracer = None
+        self.profiler = None
+        self.automation = None
+        self.meter = None
+        self._meterTap = None
+        self._kcycleHooks = []
+        self._hooksInstalled = False
+        self._scoreStreams = []
+        self._hostDriven = None
+        self._pendingSwap = None
+        self._retiring = []
+        self.engineSwaps = 0
+        self.engineGeneration = 0
+        self._compiled = False
         if csdFileName and os.path.exists(csdFileName):
             self.csd = csdFileName
             self.startThread()
@@ -39,8 +126,85 @@ class CsoundSession(ctcsound.Csound):
 
     def startThread(self):
         if self.compile_("csoundSession", self.csd) == 0:
+            self._newEngine()
             self.pt = ctcsound.CsoundPerformanceThread(self.cs)
+            self._hooksInstalled = False
+            self._profileThread(True)
+            self._installKcycleHooks()
             self.pt.play()
+
+    def addKcycleHook(self, hook):
+        """Call hook() before each k-cycle of the performance
+
+        The hooks run in the performance thread, or in the calling thread
+        with performKsmpsLoop(), and must return quickly.
+        """
+        self._kcycleHooks = self._kcycleHooks + [hook]
+        self._installKcycleHooks()
+
+    def _installKcycleHooks(self):
+        """Make the performance thread run the hooks, once there are some"""
+        if self.pt and self._kcycleHooks and not self._hooksInstalled:
+            setProcessCallback(self.pt, self._runKcycleHooks)
+            self._hooksInstalled = True
+
+    def removeKcycleHook(self, hook):
+        """Remove a hook added with addKcycleHook"""
+        self._kcycleHooks = [h for h in self._kcycleHooks if h != hook]
+
+    def performKsmpsLoop(self, *options):
+        """Perform the loaded csd in the calling thread with performKsmps()
+
+        The k-cycle hooks are run before each k-cycle. The options are passed
+        to compile_ before the csd file name, e.g. '-n' to perform without
+        sound output. Return the number of k-cycles performed, or None if the
+        csd could not be compiled.
+        """
+        if not self.csd:
+            return None
+        self.stopPerformance()
+        self.reset()
+        if self.compile_("csoundSession", *(list(options) + [self.csd])) != 0:
+            return None
+        self._newEngine()
+        self._profileThread(False)
+        profiler = self.profiler
+        if profiler:
+            profiler.budget = self.ksmps() / self.sr()
+        n = 0
+        try:
+            while True:
+                self._runKcycleHooks()
+                if profiler:
+                    profiler.begin()
+                    ret = self.performKsmps()
+                    profiler.end()
+                else:
+                    ret = self.performKsmps()
+                if ret != 0:
+                    break
+                n += 1
+        finally:
+            self._compiled = False
+            self.cleanup()
+            self.reset()
+        return n
+
+    def _newEngine(self):
+        """Note that a newly compiled engine is about to perform
+
+        engineGeneration is incremented, so that the objects holding
+        pointers into the previous engine look them up again.
+        """
+        self.engineGeneration += 1
+        self._compiled = True
+        self._meterTap = None
+        if self.automation:
+            self.automation.update()
+
+    def _runKcycleHooks(self):
+        for hook in self._kcycleHooks:
+            hook()
             
     def resetSession(self, csdFileName=None):
         """Reset the current session, eventually loading a new csd file"""
@@ -52,12 +216,22 @@ class CsoundSession(ctcsound.Csound):
 
     def stopPerformance(self):
         """Stop the current score performance if any"""
+        # The tracer table and instrument belong to the stopped engine
+        self.stopTracing()
+        for stream in self._scoreStreams:
+            stream.stop()
+        self._scoreStreams = []
         if self.pt:
             if self.pt.status() == 0:
                 self.pt.stop()
             self.pt.join()
             self.pt = None
+            self._hooksInstalled = False
+        self._compiled = False
         self.cleanup()
+        for thread in self._retiring:
+            thread.join()
+        self._retiring = []
 
     def csdFileName(self):
         """Return the loaded csd filename or None"""
@@ -65,14 +239,1411 @@ class CsoundSession(ctcsound.Csound):
         
     def note(self, pfields, absp2mode=0):
         """Send a score note to a csound instrument"""
+        if self.tracer:
+            self.tracer.traceEvent(self.pt, 'i', pfields, absp2mode)
         return self.pt.scoreEvent(absp2mode, 'i', pfields)
         
     def scoreEvent(self, eventType, pfields, absp2mode=False):
         """Send a score event to csound"""
+        if self.tracer and eventType == 'i':
+            self.tracer.traceEvent(self.pt, eventType, pfields, absp2mode)
         self.pt.scoreEvent(absp2mode, eventType, pfields)
 
+    def startTracing(self, capacity=4096, instrNum=9999):
+        """Trace the latency of the notes sent with note() and scoreEvent()
+
+        Return the EventTracer attached to the running performance. Tracing
+        stops with the performance.
+        """
+        self.tracer = EventTracer(self, capacity, instrNum)
+        self.tracer.attach(self)
+        return self.tracer
+
+    def startProfiling(self, history=4096, loadWindow=100, slack=0.05):
+        """Time every k-cycle or buffer of the performance against its budget
+
+        A running performance thread is profiled through a k-cycle hook,
+        its xruns being counted from the drift against the wall clock.
+        Return the CycleProfiler.
+        """
+        self.stopProfiling()
+        self.profiler = CycleProfiler(None, history, loadWindow, slack)
+        if self.pt:
+            self._profileThread(True)
+        return self.profiler
+
+    def _profileThread(self, on):
+        """Profile the k-cycles of the performance thread through a hook, or stop
+        doing so when the session drives the performance itself"""
+        profiler = self.profiler
+        if not profiler:
+            return
+        self.removeKcycleHook(profiler.onCycle)
+        profiler.clock = None
+        if on:
+            profiler.budget = self.ksmps() / self.sr()
+            profiler.clock = lambda: self.currentTimeSamples() / self.sr()
+            self.addKcycleHook(profiler.onCycle)
+
+    def startAutomation(self):
+        """Return an Automation attached to the session, applying its curves
+        on every k-cycle of the performance thread or of performKsmpsLoop()"""
+        if not self.automation:
+            self.automation = Automation(self)
+            self.automation.attach(self)
+        return self.automation
+
+    def stopAutomation(self):
+        """Stop applying the automation curves, returning the Automation"""
+        automation, self.automation = self.automation, None
+        if automation:
+            automation.detach()
+        return automation
+
+    def startMeter(self, **options):
+        """Meter the output of the performance with an OutputMeter
+
+        The options are passed to OutputMeter. Return the started meter.
+        """
+        self.stopMeter()
+        self.meter = OutputMeter(**options)
+        self.meter.start()
+        self._meterTap = None
+        self.addKcycleHook(self._meterCycle)
+        return self.meter
+
+    def stopMeter(self):
+        """Stop metering, returning the OutputMeter"""
+        meter, self.meter = self.meter, None
+        if meter:
+            self.removeKcycleHook(self._meterCycle)
+            meter.stop()
+        return meter
+
+    def _meterCycle(self):
+        meter = self.meter
+        if meter is None:
+            return
+        if self._meterTap is None:
+            meter.sr = self.sr()
+            self._meterTap = self.spout().reshape(-1, self.nchnls())
+        meter.push(self._meterTap)
+
+    def stopProfiling(self):
+        """Stop profiling, returning the CycleProfiler"""
+        profiler, self.profiler = self.profiler, None
+        if profiler:
+            self.removeKcycleHook(profiler.onCycle)
+        return profiler
+
+    def stopTracing(self):
+        """Stop tracing the notes, returning the EventTracer"""
+        tracer, self.tracer = self.tracer, None
+        if tracer:
+            tracer.detach()
+        return tracer
+
+    def notes(self, pfields, absp2mode=0):
+        """Send many score notes at once, one note per row of a 2-D array"""
+        self.scoreEvents(pfields, 'i', absp2mode)
+
+    def scoreEvents(self, events, eventType='i', absp2mode=False):
+        """Send many score events at once to csound
+
+        events is a 2-D array of pfields, one event of type eventType per
+        row, or a structured array with a 'type' field. Trailing NaN pfields
+        are not sent and rows of NaN only are skipped.
+        """
+        global _ptScoreEvent
+        events = np.asarray(events)
+        if events.dtype.names:
+            names = [n for n in events.dtype.names if n != 'type']
+            types = events['type']
+            if types.dtype.kind == 'U':
+                types = np.char.encode(types.astype('U1'), 'ascii')
+            types = types.astype('S1').view(np.uint8).tolist()
+            p = np.stack([events[n] for n in names], axis=1).astype(ctcsound.MYFLT)
+        else:
+            p = np.array(events, dtype=ctcsound.MYFLT, ndmin=2, order='C')
+            types = [ord(eventType)] * len(p)
+        p = np.ascontiguousarray(p)
+        nfields = p.shape[1]
+        counts = np.full(len(p), nfields, dtype=np.intp)
+        isnan = np.isnan(p)
+        if isnan.any():
+            trailing = np.argmin(isnan[:, ::-1], axis=1)
+            trailing[isnan.all(axis=1)] = nfields
+            counts -= trailing
+        addrs = (p.ctypes.data + np.arange(len(p)) * p.strides[0]).tolist()
+        if _ptScoreEvent is None:
+            _ptScoreEvent = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int,
+                ctypes.c_char, ctypes.c_int, ctypes.c_void_p)(
+                ('CsoundPTscoreEvent', ctcsound.libcspt))
+        cpt = self.pt.cpt
+        absp2mode = int(absp2mode)
+        for t, cnt, addr in zip(types, counts.tolist(), addrs):
+            if cnt:
+                _ptScoreEvent(cpt, absp2mode, t, cnt, addr)
+
+    def streamScore(self, fileName, lookahead=2.0, interval=0.05):
+        """Feed a score file into the running performance, lookahead seconds
+        ahead of the score time
+
+        The event times are counted from the current score time. Return the
+        started ScoreStream.
+        """
+        stream = ScoreStream(self, fileName, lookahead, interval)
+        self._scoreStreams.append(stream)
+        stream.start()
+        return stream
+
+    def snapshotTables(self, fileName, tables=None, maxNum=10000):
+        """Save function tables into an archive, see saveTables()"""
+        return saveTables(self, fileName, tables, maxNum)
+
+    def restoreTables(self, fileName, tables=None):
+        """Load function tables from an archive, see loadTables()"""
+        return loadTables(self, fileName, tables)
+
+    def startIngest(self, udpPort=None, tcpPort=None, host='127.0.0.1', **options):
+        """Start an IngestServer feeding this session from the network
+
+        The options are passed to IngestServer. Return the started server.
+        """
+        from ingestServer import IngestServer
+        server = IngestServer(self, host, udpPort, tcpPort, **options)
+        server.start()
+        return server
+
     def flushMessages(self):
         """Wait until all pending messages are actually received by the performance thread"""
         if self.pt:
             self.pt.flushMessageQueue()
 
+    def stream(self, prefetch=4, bufferSize=0):
+        """Perform the loaded csd and yield its output blocks as ndarrays
+
+        The blocks have the shape (frames, nchnls) and are only valid until
+        the next iteration. With prefetch > 0, a producer thread performs up
+        to prefetch blocks ahead.
+        """
+        if not self._compileHostDriven(bufferSize):
+            return
+        try:
+            if prefetch <= 0:
+                while True:
+                    block = self._performBlock()
+                    if block is None:
+                        break
+                    yield block
+                return
+            q = queue.Queue(maxsize=prefetch)
+            ring = [np.zeros_like(self._hostDriven['block']) for i in range(prefetch + 2)]
+            released = threading.Event()
+            state = {'waiting': False, 'stop': False}
+
+            def produce():
+                n = 0
+                while not state['stop']:
+                    block = self._performBlock()
+                    if block is None:
+                        break
+                    if state['waiting'] and q.empty():
+                        # Hand the live buffer over, and wait until the
+                        # consumer is done with it before performing again
+                        released.clear()
+                        q.put((block, True))
+                        released.wait()
+                    else:
+                        slot = ring[n % len(ring)]
+                        n += 1
+                        slot[:] = block
+                        q.put((slot, False))
+                q.put((None, False))
+
+            producer = threading.Thread(target=produce)
+            producer.daemon = True
+            producer.start()
+            try:
+                while True:
+                    state['waiting'] = True
+                    item, live = q.get()
+                    state['waiting'] = False
+                    if item is None:
+                        break
+                    yield item
+                    if live:
+                        released.set()
+            finally:
+                state['stop'] = True
+                while producer.is_alive():
+                    released.set()
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    producer.join(0.01)
+        finally:
+            self._endHostDriven()
+
+    def renderToFile(self, fileName, duration=None, dtype=np.float32, bufferSize=0):
+        """Render the loaded csd as fast as possible into a .npy or .wav file
+
+        The file is written through a np.memmap sized for duration seconds,
+        by default scoreEnd() of the csd. Return the rendered frames as a
+        memmap, or None if the csd could not be compiled.
+        """
+        if not self._compileHostDriven(bufferSize):
+            return None
+        try:
+            nchnls, sr = self.nchnls(), int(self.sr())
+            block = self.outputBuffer().reshape(-1, nchnls)
+            if duration is None:
+                with open(self.csd) as f:
+                    duration = scoreEnd(f.read())
+            frames = max(int(np.ceil(duration * sr)), len(block))
+            out = _FrameFile(fileName, frames, nchnls, sr, dtype)
+            written = 0
+            while True:
+                block = self._performBlock()
+                if block is None:
+                    break
+                out.write(written, block)
+                written += len(block)
+            return out.close(written)
+        finally:
+            self._endHostDriven()
+
+    def renderSharded(self, fileName, segments=None, preroll=10.0, duration=None,
+                      dtype=np.float32, bufferSize=0):
+        """Render the loaded csd in time segments on a pool of processes
+
+        Each segment starts preroll seconds early, so that the notes begun
+        before the cut are reproduced. The file and the result are those of
+        renderToFile().
+        """
+        if not self._compileHostDriven(bufferSize):
+            return None
+        try:
+            nchnls, sr = self.nchnls(), int(self.sr())
+            blockFrames = self.outputBufferSize() // nchnls
+        finally:
+            self._endHostDriven()
+        if duration is None:
+            with open(self.csd) as f:
+                duration = scoreEnd(f.read())
+        blocks = max(int(np.ceil(duration * sr / blockFrames)), 1)
+        frames = blocks * blockFrames
+        segments = min(segments or multiprocessing.cpu_count(), blocks)
+        prerollFrames = int(np.ceil(preroll * sr / blockFrames)) * blockFrames
+        out = _FrameFile(fileName, frames, nchnls, sr, dtype)
+        bounds = [(blocks * i // segments) * blockFrames for i in range(segments + 1)]
+        jobs = [(self.csd, fileName, out.headerSize, out.dtype.str, (frames, nchnls),
+                 bounds[i], bounds[i + 1], prerollFrames, bufferSize)
+                for i in range(segments)]
+        pool = multiprocessing.Pool(segments)
+        try:
+            ok = all(pool.map(_renderSegment, jobs))
+        finally:
+            pool.close()
+            pool.join()
+        result = out.close(frames)
+        return result if ok else None
+
+    def performBus(self, inBus=None, outBus=None, bufferSize=0):
+        """Perform the loaded csd as a stage of an audio pipeline
+
+        Block n of outBus is computed from block n of inBus, both AudioBus
+        instances. Return the number of blocks performed, or None if the
+        csd could not be compiled.
+        """
+        if not self._compileHostDriven(bufferSize):
+            for bus in (inBus, outBus):
+                if bus:
+                    bus.stop()
+            return None
+        # The buses are bound to the buffers of this engine
+        self._hostDriven['swappable'] = False
+        n = 0
+        try:
+            nchnls, nchnlsIn = self.nchnls(), self.nchnlsInput()
+            inBlock = self.inputBuffer().reshape(-1, nchnlsIn)
+            outBlock = self.outputBuffer().reshape(-1, nchnls)
+            for bus, block in ((inBus, inBlock), (outBus, outBlock)):
+                if bus and bus.shape != block.shape:
+                    raise ValueError("bus blocks of shape {} do not match the "
+                                     "engine buffer shape {}".format(bus.shape, block.shape))
+            while True:
+                if inBus and not inBus.get(inBlock):
+                    break
+                if self._performBuffer() != 0:
+                    break
+                if outBus and not outBus.put(outBlock):
+                    break
+                n += 1
+        finally:
+            if inBus:
+                inBus.stop()
+            if outBus:
+                outBus.finish()
+            self._endHostDriven()
+        return n
+
+    def _compileHostDriven(self, bufferSize=0):
+        """Compile the loaded csd for a performance driven by the session itself"""
+        if not self.csd:
+            return False
+        self.stopPerformance()
+        self.reset()
+        self.setHostImplementedAudioIO(1, bufferSize)
+        if self.compile_("csoundSession", self.csd) != 0:
+            return False
+        self._newEngine()
+        self._profileThread(False)
+        if self.profiler:
+            self.profiler.budget = self.outputBufferSize() / self.nchnls() / self.sr()
+        if self.meter:
+            self.meter.sr = self.sr()
+        self._hostDriven = {'bufferSize': bufferSize, 'fade': None, 'swappable': True,
+                            'block': self.outputBuffer().reshape(-1, self.nchnls())}
+        return True
+
+    def _performBuffer(self):
+        """performBuffer(), timed by the profiler and metered by the meter if any"""
+        if not self.profiler:
+            ret = self.performBuffer()
+        else:
+            self.profiler.begin()
+            ret = self.performBuffer()
+            self.profiler.end()
+        if self.meter and ret == 0:
+            self.meter.push(self.outputBuffer().reshape(-1, self.nchnls()))
+        return ret
+
+    def _performBlock(self):
+        """Perform one buffer, cutting over to a pending swapCsd() engine
+
+        Return the output block, or None at the end of the performance.
+        """
+        state = self._hostDriven
+        if state['fade'] is None and self._pendingSwap is not None:
+            standby, fadeFrames = self._pendingSwap
+            self._pendingSwap = None
+            if fadeFrames <= 0:
+                self._swapEngines(standby)
+                self._retire(standby)
+                state['block'] = self.outputBuffer().reshape(-1, self.nchnls())
+            else:
+                state['fade'] = {'standby': standby, 'frames': fadeFrames, 'pos': 0,
+                                 'block': np.zeros_like(state['block']),
+                                 'next': standby.outputBuffer().reshape(state['block'].shape)}
+        fade = state['fade']
+        if fade is None:
+            return state['block'] if self._performBuffer() == 0 else None
+        running = self._performBuffer() == 0
+        old = state['block'] if running else 0.0
+        if fade['standby'].performBuffer() != 0:
+            # The new csd ended at once: keep the current one
+            state['fade'] = None
+            self._retire(fade['standby'])
+            return state['block'] if running else None
+        n = len(fade['block'])
+        ramp = np.clip((fade['pos'] + np.arange(1, n + 1)) / float(fade['frames']), 0.0, 1.0)
+        ramp = ramp[:, np.newaxis]
+        fade['block'][:] = old * (1.0 - ramp) + fade['next'] * ramp
+        fade['pos'] += n
+        if fade['pos'] >= fade['frames']:
+            state['fade'] = None
+            self._swapEngines(fade['standby'])
+            self._retire(fade['standby'])
+            state['block'] = self.outputBuffer().reshape(-1, self.nchnls())
+        return fade['block']
+
+    def swapCsd(self, csdFileName, crossfade=0.0):
+        """Replace the loaded csd by csdFileName without stopping the output
+
+        The new csd is started on a standby engine, which takes over at the
+        next k-cycle, or at the next block with a crossfade of crossfade
+        seconds when the session drives the performance. Return False if
+        the new csd could not be compiled. The csd of a performBus() stage
+        cannot be swapped.
+        """
+        state = self._hostDriven
+        if state and not state['swappable']:
+            raise RuntimeError("the csd of a performBus() stage cannot be swapped")
+        standby = ctcsound.Csound()
+        if state:
+            standby.setHostImplementedAudioIO(1, state['bufferSize'])
+        if standby.compile_("csoundSession", csdFileName) != 0:
+            return False
+        if state and (standby.outputBufferSize() != state['block'].size or
+                      standby.sr() != self.sr()):
+            self._retire(standby)
+            raise ValueError("{} does not match the buffer size and sample rate "
+                             "of the current performance".format(csdFileName))
+        pt = None
+        if self.pt and not state:
+            pt = ctcsound.CsoundPerformanceThread(standby.cs)
+            started = threading.Event()
+            setProcessCallback(pt, started.set)
+            pt.play()
+            while not started.wait(0.01):
+                if pt.status() != 0:
+                    self._retire(standby, pt)
+                    return False
+        self.stopTracing()
+        for stream in self._scoreStreams:
+            stream.stop()
+        self._scoreStreams = []
+        self.csd = csdFileName
+        if state:
+            self._pendingSwap = (standby, int(round(crossfade * self.sr())))
+            return True
+        oldPt = self.pt
+        if oldPt:
+            setProcessCallback(oldPt, None)
+        self._swapEngines(standby)
+        self._hooksInstalled = False
+        if pt:
+            # Remove the start detection callback
+            setProcessCallback(pt, None)
+            self.pt = pt
+            self._installKcycleHooks()
+        else:
+            self.pt = ctcsound.CsoundPerformanceThread(self.cs)
+            self._installKcycleHooks()
+            self.pt.play()
+        self._retire(standby, oldPt)
+        return True
+
+    def _swapEngines(self, standby):
+        """Make the engine of standby the session engine, and conversely"""
+        self.cs, standby.cs = standby.cs, self.cs
+        self.engineSwaps += 1
+        self._newEngine()
+        if self.profiler:
+            if self._hostDriven:
+                self.profiler.budget = self.outputBufferSize() / self.nchnls() / self.sr()
+            else:
+                self.profiler.budget = self.ksmps() / self.sr()
+            self.profiler.resync()
+
+    def _retire(self, engine, pt=None):
+        """Stop and destroy an engine in a background thread
+
+        Without a performance thread, the engine is destroyed by the
+        background thread, whichever thread drops the engine object.
+        """
+        handle = None
+        if pt is None:
+            handle, engine.fromPointer = engine.cs, True
+
+        def retire():
+            if pt:
+                if pt.status() == 0:
+                    pt.stop()
+                pt.join()
+            engine.cleanup()
+            engine.reset()
+            if handle is not None:
+                ctcsound.libcsound.csoundDestroy(handle)
+        thread = threading.Thread(target=retire)
+        thread.daemon = True
+        self._retiring = [t for t in self._retiring if t.is_alive()] + [thread]
+        thread.start()
+
+    def _endHostDriven(self):
+        pending, self._pendingSwap = self._pendingSwap, None
+        if pending:
+            self._retire(pending[0])
+        fade, self._hostDriven = self._hostDriven['fade'], None
+        if fade:
+            self._retire(fade['standby'])
+        self._compiled = False
+        self.cleanup()
+        self.reset()
+        self.setHostImplementedAudioIO(0, 0)
+
+
+class ChannelSampler:
+    """Record control channels on every k-cycle into preallocated ring buffers
+
+    The values are recorded every `every` k-cycles, the last capacity
+    records being kept. The channels are looked up again for each new
+    engine. window() reads the records without blocking the performance.
+    """
+
+    def __init__(self, cs, names, capacity=65536, every=1):
+        self.cs = cs
+        self.names = list(names)
+        self.capacity = capacity
+        self.every = every
+        self._views = None
+        self._generation = 0
+        self.values = np.zeros((capacity, len(self.names)), dtype=ctcsound.MYFLT)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self._cycle = 0
+        self._target = None
+
+    def attach(self, target):
+        """Start sampling the performance of a CsoundSession or a CsoundPerformanceThread"""
+        self._target = target
+        self._views = None
+        if isinstance(target, CsoundSession):
+            target.addKcycleHook(self.sample)
+        else:
+            setProcessCallback(target, self.sample)
+
+    def detach(self):
+        """Stop sampling"""
+        if isinstance(self._target, CsoundSession):
+            self._target.removeKcycleHook(self.sample)
+        elif self._target is not None:
+            setProcessCallback(self._target, None)
+        self._target = None
+
+    def sample(self):
+        """Record the channels, called before each k-cycle"""
+        self._cycle += 1
+        if self._cycle < self.every:
+            return
+        self._cycle = 0
+        generation = getattr(self.cs, 'engineGeneration', 0)
+        if self._views is None or generation != self._generation:
+            self._generation = generation
+            self._views = channelViews(self.cs, self.names)
+        i = self.count % self.capacity
+        self.values[i] = [v[0] for v in self._views]
+        self.times[i] = self.cs.currentTimeSamples()
+        self.count += 1
+
+    def window(self, n=None, decimate=1):
+        """Return the last n records as (times, values), keeping one record in decimate
+
+        values has one column per channel. At most capacity - 1 records
+        are returned, the oldest slot being the one the sampler may be
+        writing. Records overwritten while being copied are dropped.
+        """
+        end = self.count
+        n = min(end, self.capacity - 1) if n is None else min(n, end, self.capacity - 1)
+        idx = np.arange(end - n, end)[::-1][::decimate][::-1]
+        times = self.times[idx % self.capacity]
+        values = self.values[idx % self.capacity]
+        valid = idx >= self.count - self.capacity + 1
+        return times[valid], values[valid]
+
+
+class Automation:
+    """Control channel automation from precomputed curves, applied on every
+    k-cycle
+
+    The curves are resampled once to one value per k-cycle and written into
+    their channels with vectorized operations, the time being taken from
+    currentTimeSamples(). A channel keeps the last value of its curve.
+    """
+
+    def __init__(self, cs):
+        self.cs = cs
+        self._curves = collections.OrderedDict()
+        self._resampled = {}
+        self._plan = None
+        self._target = None
+
+    def add(self, channel, values, start=0.0, rate=None):
+        """Automate channel with values sampled at rate Hz from time start
+
+        rate defaults to the control rate. A curve already set for the
+        channel is replaced.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self._curves[channel] = ('samples', start, rate, values)
+        self.update()
+
+    def addBreakpoints(self, channel, times, values, start=0.0):
+        """Automate channel with a linear curve through (times, values)
+
+        The times are in seconds from start and must be increasing.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if times.shape != values.shape or times.ndim != 1 or not len(times):
+            raise ValueError("times and values must be 1-D arrays of the same length")
+        self._curves[channel] = ('breakpoints', start, times, values)
+        self.update()
+
+    def remove(self, channel):
+        """Stop automating channel"""
+        if self._curves.pop(channel, None) is not None:
+            self._resampled.pop(channel, None)
+            self.update()
+
+    def clear(self):
+        """Remove all the curves"""
+        self._curves.clear()
+        self._resampled.clear()
+        self.update()
+
+    def update(self):
+        """Rebuild the plan applied on each k-cycle, once attached
+
+        This is called by the methods changing the curves and by the
+        session after each compilation, so that the plan is not built in
+        the performance thread.
+        """
+        if self._target is not None and getattr(self.cs, '_compiled', True):
+            self._plan = self._build()
+        else:
+            self._plan = None
+
+    def attach(self, target):
+        """Start applying the curves to the performance of a CsoundSession or
+        a CsoundPerformanceThread"""
+        self._target = target
+        self._plan = None
+        if isinstance(target, CsoundSession):
+            target.addKcycleHook(self.apply)
+        else:
+            setProcessCallback(target, self.apply)
+
+    def detach(self):
+        """Stop applying the curves"""
+        if isinstance(self._target, CsoundSession):
+            self._target.removeKcycleHook(self.apply)
+        elif self._target is not None:
+            setProcessCallback(self._target, None)
+        self._target = None
+
+    def apply(self):
+        """Write the values of the current k-cycle, called before each k-cycle"""
+        plan = self._plan
+        if plan is None or plan[0] != getattr(self.cs, 'engineGeneration', 0):
+            plan = self._plan = self._build()
+        generation, ksmps, starts, lengths, offsets, data, write = plan
+        if not len(starts):
+            return
+        pos = self.cs.currentTimeSamples() // ksmps - starts
+        active = (pos >= 0) & (pos < lengths)
+        if active.any():
+            write(active, data[offsets[active] + pos[active]])
+
+    def _build(self):
+        """Resample the curves to the control rate and look the channels up
+
+        The resampled curves are kept until the control rate changes.
+        """
+        cs = self.cs
+        generation = getattr(cs, 'engineGeneration', 0)
+        ksmps = cs.ksmps()
+        kr = cs.sr() / ksmps
+        curves = list(self._curves.items())
+        starts, lengths, arrays = [], [], []
+        for channel, curve in curves:
+            kind, start, a, b = curve
+            cached = self._resampled.get(channel)
+            if cached is not None and cached[:2] == (kr, curve):
+                k = cached[2]
+            elif kind == 'samples':
+                rate, values = a or kr, b
+                n = int(np.ceil(len(values) * kr / rate))
+                k = np.interp(np.arange(n) / kr, np.arange(len(values)) / rate, values)
+            else:
+                times, values = a, b
+                n = int(np.floor(times[-1] * kr)) + 1
+                k = np.interp(np.arange(n) / kr, times, values)
+            self._resampled[channel] = (kr, curve, k)
+            starts.append(int(round(start * kr)))
+            lengths.append(len(k))
+            arrays.append(k)
+        data = np.concatenate(arrays).astype(ctcsound.MYFLT) if arrays else \
+            np.zeros(0, ctcsound.MYFLT)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.intp)
+        views = channelViews(cs, [channel for channel, curve in curves])
+        write = self._writer(views)
+        return (generation, ksmps, np.array(starts, dtype=np.int64),
+                np.array(lengths, dtype=np.int64), offsets, data, write)
+
+    @staticmethod
+    def _writer(views):
+        """Return a function writing values into the channels selected by a mask
+
+        When the channels are MYFLT aligned with each other, a single view
+        spanning them is written with an index array (see channelSpan()).
+        """
+        span, index = channelSpan(views)
+        if span is not None:
+            def write(mask, values):
+                span[index[mask]] = values
+            return write
+
+        def write(mask, values):
+            for i, value in zip(np.flatnonzero(mask), values):
+                views[i][0] = value
+        return write
+
+
+class OutputMeter:
+    """Levels and spectra of an audio output, computed in a worker thread
+
+    push() copies the output blocks into a lock-free ring, dropping them
+    when it is full. The worker computes the RMS, peak, true peak and
+    spectrum of each channel every interval seconds into latest.
+    """
+
+    def __init__(self, sr=None, history=256, queueSize=64, maxFrames=8192,
+                 fftSize=2048, oversample=4, interval=0.02):
+        self.sr = sr
+        self.queueSize = queueSize
+        self.maxFrames = maxFrames
+        self.fftSize = fftSize
+        self.oversample = oversample
+        self.interval = interval
+        self.historySize = history
+        self.pushed = 0
+        self.dropped = 0
+        self.analyzed = 0
+        self.latest = None
+        self._spectrum = None
+        self._slots = None
+        self._lengths = np.zeros(queueSize, dtype=np.intp)
+        self._write = 0
+        self._read = 0
+        self._tail = None
+        self._window = np.hanning(fftSize)
+        self._history = None
+        self._batches = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the worker thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the worker thread, after analyzing the queued blocks"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.analyze()
+
+    def push(self, block):
+        """Queue a copy of block, return False if it was dropped"""
+        write = self._write
+        if write - self._read >= self.queueSize:
+            self.dropped += 1
+            return False
+        if self._slots is None:
+            self._slots = np.zeros((self.queueSize, self.maxFrames, block.shape[1]),
+                                   dtype=block.dtype)
+        i = write % self.queueSize
+        n = min(len(block), self.maxFrames)
+        self._slots[i, :n] = block[:n]
+        self._lengths[i] = n
+        self._write = write + 1
+        self.pushed += 1
+        return True
+
+    def analyze(self):
+        """Analyze the queued blocks, called periodically by the worker thread"""
+        read, write = self._read, self._write
+        if write == read:
+            return
+        idx = np.arange(read, write) % self.queueSize
+        x = np.concatenate([self._slots[i, :self._lengths[i]] for i in idx]).astype(np.float64)
+        self._read = write
+        self.analyzed += write - read
+        n, nchnls = x.shape
+        rms = np.sqrt(np.mean(x * x, axis=0))
+        peak = np.max(np.abs(x), axis=0)
+        truePeak = peak
+        if self.oversample > 1 and n > 1:
+            up = np.fft.irfft(np.fft.rfft(x, axis=0), n * self.oversample, axis=0)
+            truePeak = np.maximum(peak, np.max(np.abs(up), axis=0) * self.oversample)
+        if self._tail is None or self._tail.shape[1] != nchnls:
+            self._tail = np.zeros((self.fftSize, nchnls))
+        if n >= self.fftSize:
+            self._tail[:] = x[-self.fftSize:]
+        else:
+            self._tail[:-n] = self._tail[n:]
+            self._tail[-n:] = x
+        mag = np.abs(np.fft.rfft(self._tail * self._window[:, np.newaxis], axis=0))
+        self._spectrum = (20 * np.log10(mag * 2 / self._window.sum() + 1e-12)).T
+        now = time.time()
+        if self._history is None or self._history['rms'].shape[1] != nchnls:
+            self._history = dict((name, np.zeros((self.historySize, nchnls)))
+                                 for name in ('rms', 'peak', 'truePeak'))
+            self._history['time'] = np.zeros(self.historySize)
+            self._batches = 0
+        h = self._batches % self.historySize
+        for name, value in (('rms', rms), ('peak', peak), ('truePeak', truePeak)):
+            self._history[name][h] = value
+        self._history['time'][h] = now
+        self._batches += 1
+        self.latest = {'time': now, 'frames': n, 'rms': rms, 'peak': peak,
+                       'truePeak': truePeak}
+
+    def spectrum(self):
+        """Return (frequencies, magnitudes in dB with one row per channel)"""
+        spectrum = self._spectrum
+        if spectrum is None:
+            return None, None
+        freqs = np.fft.rfftfreq(self.fftSize, 1.0 / self.sr if self.sr else 1.0)
+        return freqs, spectrum
+
+    def history(self, n=None):
+        """Return the results of the last n batches, oldest first, as a dict
+        of arrays with one row per batch"""
+        if self._history is None:
+            return None
+        count = min(self._batches, self.historySize)
+        n = count if n is None else min(n, count)
+        idx = np.arange(self._batches - n, self._batches) % self.historySize
+        return dict((name, values[idx]) for name, values in self._history.items())
+
+    @staticmethod
+    def dB(value):
+        """Convert linear levels to dBFS, relative to 0dbfs = 1"""
+        return 20 * np.log10(np.maximum(value, 1e-12))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.analyze()
+
+
+class CycleProfiler:
+    """Timing statistics of performance cycles against their real-time budget
+
+    A cycle longer than the budget counts as an xrun. When clock is set,
+    the cycles are paced by an audio device: an xrun is counted each time
+    the performance falls behind the wall clock by slack more seconds, and
+    the load is None.
+    """
+
+    def __init__(self, budget=None, history=4096, loadWindow=100, slack=0.05):
+        self.budget = budget
+        self.costs = np.zeros(history)
+        self.cycles = 0
+        self.xruns = 0
+        self.worst = 0.0
+        self.loadWindow = loadWindow
+        self.clock = None
+        self.slack = slack
+        self.lag = 0.0
+        self._t0 = None
+        self._origin = None
+
+    def begin(self):
+        self._t0 = time.perf_counter()
+
+    def end(self):
+        self.record(time.perf_counter() - self._t0)
+
+    def onCycle(self):
+        now = time.perf_counter()
+        if self._t0 is not None:
+            self.record(now - self._t0)
+        self._t0 = now
+        if self.clock:
+            self._drift(now, self.clock())
+
+    def resync(self):
+        """Restart the interval and drift measures, e.g. on an engine change"""
+        self._t0 = None
+        self._origin = None
+        self.lag = 0.0
+
+    def record(self, cost):
+        """Record the cost of one cycle"""
+        self.costs[self.cycles % len(self.costs)] = cost
+        self.cycles += 1
+        if cost > self.worst:
+            self.worst = cost
+        if self.budget and not self.clock and cost > self.budget:
+            self.xruns += 1
+
+    def _drift(self, now, perfTime):
+        if self._origin is None:
+            self._origin = now - perfTime
+            return
+        lag = now - self._origin - perfTime
+        if lag > self.lag + self.slack:
+            self.xruns += 1
+            self.lag = lag
+
+    def recent(self, n=None):
+        """Return the costs of the last n cycles, oldest first"""
+        size = len(self.costs)
+        n = min(self.cycles, size) if n is None else min(n, self.cycles, size)
+        idx = np.arange(self.cycles - n, self.cycles) % size
+        return self.costs[idx]
+
+    def load(self):
+        """Return the mean cost of the last cycles relative to the budget"""
+        if self.clock:
+            return None
+        recent = self.recent(self.loadWindow)
+        if not len(recent) or not self.budget:
+            return 0.0
+        return float(recent.mean() / self.budget)
+
+    def percentiles(self, q=(50, 90, 99, 99.9)):
+        """Return the percentiles q of the recent cycle costs"""
+        recent = self.recent()
+        return dict((p, float(np.percentile(recent, p)) if len(recent) else 0.0) for p in q)
+
+    def stats(self):
+        """Return a dict of all the figures"""
+        return {'cycles': self.cycles, 'xruns': self.xruns, 'budget': self.budget,
+                'worst': self.worst, 'load': self.load(),
+                'percentiles': self.percentiles()}
+
+
+class EventTracer:
+    """Trace score events from their submission to the start of their instrument
+
+    Each traced event is paired with an event of a trace instrument which
+    records its first k-cycle. The latencies are split into the queue delay,
+    in seconds, and the engine delay, in k-cycles and seconds.
+    """
+
+    def __init__(self, cs, capacity=4096, instrNum=9999):
+        self.cs = cs
+        self.capacity = capacity
+        self.instrNum = instrNum
+        self.submitTimes = np.full(capacity, np.nan)
+        self.offsets = np.zeros(capacity)
+        self.reachCycles = np.full(capacity, -1, dtype=np.int64)
+        self.reachTimes = np.full(capacity, np.nan)
+        self.count = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._table = None
+        self._target = None
+
+    def install(self):
+        """Compile the trace instrument and its table"""
+        self.cs.compileOrc("""
+giEventTrace_ ftgen 0, 0, -{0}, -2, 0
+instr {1}
+icycle timek
+tableiw icycle + 1, p4, giEventTrace_
+turnoff
+endin
+""".format(self.capacity, self.instrNum))
+        self._table = self.cs.table(int(self.cs.evalCode("return giEventTrace_")))
+
+    def attach(self, target):
+        """Install the tracer on a CsoundPerformanceThread, or on an object
+        with k-cycle hooks such as a CsoundSession"""
+        if self._table is None:
+            self.install()
+        self._target = target
+        if hasattr(target, 'addKcycleHook'):
+            target.addKcycleHook(self.onCycle)
+        else:
+            setProcessCallback(target, self.onCycle)
+
+    def detach(self):
+        """Stop noting the k-cycles"""
+        if hasattr(self._target, 'removeKcycleHook'):
+            self._target.removeKcycleHook(self.onCycle)
+        elif self._target is not None:
+            setProcessCallback(self._target, None)
+        self._target = None
+
+    def tag(self, p2=0.0, relative=True):
+        """Register an event submitted now and return its trace slot"""
+        with self._lock:
+            slot = self.count % self.capacity
+            self.count += 1
+            self.submitTimes[slot] = time.time()
+            self.offsets[slot] = p2 if relative else np.nan
+            self.reachCycles[slot] = -1
+            self.reachTimes[slot] = np.nan
+            self._table[slot] = 0
+            self._pending.append(slot)
+        return slot
+
+    def traceEvent(self, pt, eventType, pfields, absp2mode=False):
+        """Tag an event about to be sent to pt and send its companion event"""
+        p2 = float(pfields[1]) if len(pfields) > 1 else 0.0
+        slot = self.tag(p2, not absp2mode)
+        pt.scoreEvent(absp2mode, 'i', (self.instrNum, p2, -1, slot))
+
+    def traceScore(self, score):
+        """Tag the i statements of a score text and return it with its companion events
+
+        Only the i statements with a numeric start time are traced.
+        """
+        lines = [score]
+        for line in score.splitlines():
+            fields = line.split(';')[0].split()
+            if not fields or fields[0][0] != 'i':
+                continue
+            fields = ([fields[0][1:]] if len(fields[0]) > 1 else []) + fields[1:]
+            try:
+                p2 = float(fields[1])
+            except (IndexError, ValueError):
+                continue
+            lines.append('i {} {} -1 {}'.format(self.instrNum, p2, self.tag(p2)))
+        return '\n'.join(lines) + '\n'
+
+    def onCycle(self):
+        """Note the k-cycle reached by the pending events, called before each k-cycle"""
+        if not self._pending:
+            return
+        cycle = self.cs.currentTimeSamples() // self.cs.ksmps()
+        now = time.time()
+        with self._lock:
+            pending, self._pending = self._pending, []
+            for slot in pending:
+                self.reachCycles[slot] = cycle
+                self.reachTimes[slot] = now
+
+    def latencies(self):
+        """Return a dict of arrays of latencies of the events that started
+
+        queue: submission to performance thread (s), engineCycles:
+        performance thread to instrument start (k-cycles), engine: the same
+        in seconds, total: queue + engine, less the requested relative p2.
+        """
+        n = min(self.count, self.capacity)
+        started = np.asarray(self._table[:n]) > 0
+        done = started & (self.reachCycles[:n] >= 0)
+        kdur = self.cs.ksmps() / self.cs.sr()
+        queue = (self.reachTimes[:n] - self.submitTimes[:n])[done]
+        cycles = np.maximum(np.asarray(self._table[:n])[done] - 1 - self.reachCycles[:n][done], 0)
+        engine = cycles * kdur - np.nan_to_num(self.offsets[:n][done])
+        return {'queue': queue, 'engineCycles': cycles, 'engine': engine,
+                'total': queue + engine}
+
+    def percentiles(self, q=(50, 90, 95, 99, 100)):
+        """Return the percentiles q of each kind of latency"""
+        lat = self.latencies()
+        return dict((kind, dict((str(p), float(np.percentile(v, p)) if len(v) else None)
+                                for p in q))
+                    for kind, v in lat.items())
+
+    def histograms(self, bins=50):
+        """Return (counts, bin edges) of each kind of latency"""
+        return dict((kind, np.histogram(v, bins)) for kind, v in self.latencies().items())
+
+    def toJSON(self, bins=50):
+        """Return the percentiles and histograms as a JSON string"""
+        hist = dict((kind, {'counts': c.tolist(), 'edges': e.tolist()})
+                    for kind, (c, e) in self.histograms(bins).items())
+        return json.dumps({'events': len(self.latencies()['total']),
+                           'percentiles': self.percentiles(), 'histograms': hist})
+
+
+def scoreEnd(text):
+    """Estimate the end time of a score, or of the score of a csd text
+
+    The end time is the latest end of the i statements (with numeric,
+    carried or + start times), of the f 0 statements and of the e
+    statements, sections being chained. Tempo statements are ignored, so
+    the result is in beats. Held notes (negative p3) count for their start
+    time only. A csd without score ends at 0.
+    """
+    m = re.search(r'<CsScore[^>]*>(.*?)</CsScore>', text, re.S)
+    if m:
+        text = m.group(1)
+    elif re.search(r'<CsoundSynthesizer>|<CsInstruments>', text):
+        return 0.0
+    end = 0.0
+    for op, start, fields in scoreStatements(text.splitlines()):
+        if op == 'i':
+            end = max(end, start + max(float(fields[2]), 0.0))
+        elif (op == 'f' and float(fields[0]) == 0) or op == 'e':
+            end = max(end, start)
+    return end
+
+
+def scoreStatements(lines):
+    """Parse score lines lazily, yielding (op, start, fields) per statement
+
+    lines is any iterable of score lines, e.g. an open score file, which is
+    read as the statements are consumed. The i, f and e statements are
+    yielded with their absolute start time in beats, sections being
+    chained, and their fields (without the opcode), the start time field
+    being replaced by the absolute start time. The carried i fields (.),
+    the + and ^+ start times are resolved. The other statements are
+    yielded with a start time of None; s statements, and the i and f
+    statements missing their time fields, are not yielded.
+    """
+    base = end = 0.0
+    prev = []
+    for line in lines:
+        fields = line.split(';')[0].split()
+        if not fields:
+            continue
+        op = fields[0][0]
+        fields = ([fields[0][1:]] if len(fields[0]) > 1 else []) + fields[1:]
+        if (op == 'i' and len(fields) < 3) or (op == 'f' and len(fields) < 2):
+            continue
+        try:
+            if op == 'i':
+                carried = fields[1] == '.'
+                fields = [prev[k] if f == '.' and k < len(prev) else f
+                          for k, f in enumerate(fields)]
+                if fields[1] == '+':
+                    start = float(prev[1]) + float(prev[2])
+                elif fields[1].startswith('^+'):
+                    start = float(prev[1]) + float(fields[1][2:])
+                elif carried:
+                    start = float(fields[1])
+                else:
+                    start = base + float(fields[1])
+                fields[1] = repr(start)
+                end = max(end, start + max(float(fields[2]), 0.0))
+                prev = fields
+            elif op == 'f':
+                start = base + float(fields[1])
+                fields = [fields[0], repr(start)] + fields[2:]
+                if float(fields[0]) == 0:
+                    end = max(end, start)
+            elif op == 'e':
+                start = base + float(fields[0]) if fields else end
+                fields = [repr(start)] + fields[1:] if fields else fields
+                end = max(end, start)
+            elif op == 's':
+                base = end
+                continue
+            else:
+                start = None
+        except (ValueError, IndexError):
+            continue
+        yield op, start, fields
+
+
+class ScoreStream:
+    """Send the events of a score file to a running CsoundSession, a bounded
+    time ahead of the performance
+
+    The file, sorted by start time, is read lazily and its i and f
+    statements are sent once within lookahead seconds of their start.
+    Tempo statements are ignored and an e statement ends the stream.
+    """
+
+    def __init__(self, cs, fileName, lookahead=2.0, interval=0.05):
+        self.cs = cs
+        self.fileName = fileName
+        self.lookahead = lookahead
+        self.interval = interval
+        self.offset = 0.0
+        self.sent = 0
+        self.late = 0
+        self.position = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start streaming from the current score time"""
+        self.offset = self.cs.scoreTime()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop streaming and wait for the streaming thread"""
+        self._stop.set()
+        self.join()
+
+    def join(self, timeout=None):
+        """Wait until the whole file has been sent or the stream is stopped"""
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def done(self):
+        """Return True when the streaming thread has ended"""
+        return self._thread is not None and not self._thread.is_alive()
+
+    def _run(self):
+        with open(self.fileName) as f:
+            for op, start, fields in scoreStatements(f):
+                if op == 'e':
+                    break
+                if op not in 'if':
+                    continue
+                t = self.offset + start
+                while t > self.cs.scoreTime() + self.lookahead:
+                    if self._stop.wait(self.interval):
+                        return
+                if self._stop.is_set() or not self._send(op, t, fields):
+                    return
+                self.position = t
+
+    def _send(self, op, t, fields):
+        pt = self.cs.pt
+        if pt is None:
+            return False
+        now = self.cs.scoreTime()
+        if t < now:
+            self.late += 1
+        try:
+            pfields = [float(f) for f in fields]
+        except ValueError:
+            fields[1] = repr(max(t - now, 0.0))
+            pt.inputMessage('{} {}'.format(op, ' '.join(fields)))
+        else:
+            pfields[1] = t
+            pt.scoreEvent(1, op, pfields)
+        self.sent += 1
+        return True
+
+
+_tableMagic = b'CSTABLES'
+
+def saveTables(cs, fileName, tables=None, maxNum=10000):
+    """Save function tables of a running engine into an archive file
+
+    tables is a list of table numbers, by default all the tables numbered
+    from 1 to maxNum. The archive holds a header with the number and size
+    of each table followed by their data, written through a np.memmap.
+    Return the list of the saved table numbers.
+    """
+    if tables is None:
+        tables = [n for n in range(1, maxNum + 1) if cs.tableLength(n) > 0]
+    sizes = [cs.tableLength(n) for n in tables]
+    tables = [n for n, size in zip(tables, sizes) if size > 0]
+    sizes = [size for size in sizes if size > 0]
+    index = np.array([len(tables)] + [x for pair in zip(tables, sizes) for x in pair],
+                     dtype=np.int64)
+    dtype = np.dtype(ctcsound.MYFLT)
+    offset = len(_tableMagic) + index.nbytes
+    with open(fileName, 'wb') as f:
+        f.write(_tableMagic)
+        f.write(index.tobytes())
+        f.truncate(offset + sum(sizes) * dtype.itemsize)
+    if tables:
+        data = np.memmap(fileName, dtype, 'r+', offset, (sum(sizes),))
+        pos = 0
+        for num, size in zip(tables, sizes):
+            data[pos:pos + size] = cs.table(num)
+            pos += size
+        data.flush()
+    return tables
+
+
+def loadTables(cs, fileName, tables=None, compileCode=None):
+    """Load function tables saved by saveTables() into a running engine
+
+    tables is a list of the table numbers to load, by default all the
+    tables of the archive. The missing tables, and the tables with another
+    size, are created empty with a single call of compileCode(code), by
+    default cs.compileOrc, then the data are copied from the memory-mapped
+    archive into the tables. Return the list of the loaded table numbers.
+    """
+    header = np.memmap(fileName, np.uint8, 'r')
+    if bytes(header[:len(_tableMagic)]) != _tableMagic:
+        raise ValueError("{} is not a table archive".format(fileName))
+    count = int(header[8:16].view(np.int64)[0])
+    index = header[16:16 + 16 * count].view(np.int64).reshape(count, 2)
+    offset = len(_tableMagic) + 8 * (2 * count + 1)
+    dtype = np.dtype(ctcsound.MYFLT)
+    data = np.memmap(fileName, dtype, 'r', offset, (int(index[:, 1].sum()),))
+    starts = np.concatenate(([0], np.cumsum(index[:, 1])))
+    wanted = None if tables is None else set(tables)
+    entries = [(int(num), int(size), int(start))
+               for (num, size), start in zip(index, starts)
+               if wanted is None or num in wanted]
+    code = ['gitemp_ ftgen {}, 0, {}, -2, 0'.format(num, size)
+            for num, size, start in entries if cs.tableLength(num) != size]
+    if code:
+        (compileCode or cs.compileOrc)('\n'.join(code))
+    for num, size, start in entries:
+        table = cs.table(num)
+        src = data[start:start + size]
+        ctypes.memmove(table.ctypes.data, src.ctypes.data, size * dtype.itemsize)
+    return [num for num, size, start in entries]
+
+
+class _FrameFile:
+    """A .npy or float WAV file of frames, written through a growable np.memmap"""
+
+    headerSize = 128
+
+    def __init__(self, fileName, frames, nchnls, sr, dtype):
+        self.fileName = fileName
+        self.nchnls = nchnls
+        self.sr = sr
+        self.dtype = np.dtype(dtype)
+        self.wav = fileName.lower().endswith('.wav')
+        if self.wav:
+            self.headerSize = 44
+        self.frames = 0
+        self.array = None
+        with open(fileName, 'wb'):
+            pass
+        self._resize(frames)
+
+    def write(self, start, block):
+        """Write block at frame start, growing the file if needed"""
+        end = start + len(block)
+        if end > self.frames:
+            self._resize(max(end, 2 * self.frames))
+        self.array[start:end] = block
+
+    def close(self, frames):
+        """Truncate the file to frames and return them as a read-only memmap"""
+        self._resize(frames)
+        self.array = None
+        if frames == 0:
+            return np.zeros((0, self.nchnls), self.dtype)
+        return np.memmap(self.fileName, self.dtype, 'r', self.headerSize,
+                         (frames, self.nchnls))
+
+    def _resize(self, frames):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+        frameSize = self.nchnls * self.dtype.itemsize
+        with open(self.fileName, 'r+b') as f:
+            f.truncate(self.headerSize + frames * frameSize)
+            f.write(self._header(frames))
+        self.frames = frames
+        if frames > 0:
+            self.array = np.memmap(self.fileName, self.dtype, 'r+', self.headerSize,
+                                   (frames, self.nchnls))
+
+    def _header(self, frames):
+        if self.wav:
+            dataSize = frames * self.nchnls * self.dtype.itemsize
+            bits = 8 * self.dtype.itemsize
+            return (b'RIFF' + struct.pack('<I', 36 + dataSize) + b'WAVEfmt ' +
+                    struct.pack('<IHHIIHH', 16, 3, self.nchnls, self.sr,
+                                self.sr * self.nchnls * bits // 8,
+                                self.nchnls * bits // 8, bits) +
+                    b'data' + struct.pack('<I', dataSize))
+        d = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(
+            self.dtype.str, frames, self.nchnls)
+        d = d.ljust(self.headerSize - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(d)) + d.encode('latin1')
+
+
+def _renderSegment(job):
+    """Render the frames [start, end) of a csd into a shared output file"""
+    csd, fileName, headerSize, dtype, shape, start, end, preroll, bufferSize = job
+    cs = ctcsound.Csound()
+    cs.createMessageBuffer(0)
+    cs.setHostImplementedAudioIO(1, bufferSize)
+    if cs.compile_("csoundSession", csd) != 0:
+        return False
+    first = max(start - preroll, 0)
+    cs.setScoreOffsetSeconds(first / cs.sr())
+    out = np.memmap(fileName, dtype, 'r+', headerSize, shape)
+    block = cs.outputBuffer().reshape(-1, shape[1])
+    pos = first
+    while pos < end and cs.performBuffer() == 0:
+        a, b = max(pos, start), min(pos + len(block), end)
+        if b > a:
+            out[a:b] = block[a - pos:b - pos]
+        pos += len(block)
+    out.flush()
+    cs.cleanup()
+    cs.reset()
+    return True
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# ingestServer.py:
+#
+# Copyright (C) 2016 Francois Pinot
+#
+# This code is free software; you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this code; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# 02111-1307 USA
+#
+
+import collections
+import select
+import socket
+import threading
+import time
+
+
+class IngestServer:
+    """Receive score lines and channel updates from the network and submit
+    them to a CsoundSession in one batch per k-cycle
+
+    The server listens on a UDP port and/or a TCP port (0 for any free
+    port, see udpAddress and tcpAddress). Messages are text lines, several
+    lines per datagram or TCP read being allowed: a line '@name value'
+    sets the control channel name, any other line is a score line (e.g.
+    'i 1 0 0.5 440'). A network thread parses the lines into bounded
+    queues; a k-cycle hook of the session submits before each k-cycle at
+    most eventsPerCycle score lines, as one inputMessage(), and the latest
+    value of each updated channel, so that floods of channel updates are
+    coalesced to one setControlChannel() per channel and k-cycle.
+
+    When maxEvents score lines are pending, overflow chooses whether the
+    newest ('dropNewest') or the oldest ('dropOldest') line is dropped.
+    Updates of channels beyond maxChannels distinct pending channels are
+    dropped. The counters are read with stats().
+    """
+
+    def __init__(self, cs, host='127.0.0.1', udpPort=None, tcpPort=None,
+                 maxEvents=65536, maxChannels=4096, eventsPerCycle=1024,
+                 overflow='dropNewest'):
+        if overflow not in ('dropNewest', 'dropOldest'):
+            raise ValueError("overflow must be 'dropNewest' or 'dropOldest'")
+        self.cs = cs
+        self.maxEvents = maxEvents
+        self.maxChannels = maxChannels
+        self.eventsPerCycle = eventsPerCycle
+        self.overflow = overflow
+        self._events = collections.deque()
+        self._channels = {}
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(('bytes', 'lines', 'events', 'channelUpdates',
+                                       'coalesced', 'droppedEvents', 'droppedUpdates',
+                                       'malformed', 'batches', 'submittedEvents',
+                                       'submittedUpdates'), 0)
+        self._started = None
+        self._udp = self._tcp = None
+        self.udpAddress = self.tcpAddress = None
+        if udpPort is not None:
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._udp.bind((host, udpPort))
+            self.udpAddress = self._udp.getsockname()
+        if tcpPort is not None:
+            self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._tcp.bind((host, tcpPort))
+            self._tcp.listen(16)
+            self.tcpAddress = self._tcp.getsockname()
+        self._connections = {}
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start receiving and submitting"""
+        self._running = True
+        self._started = time.time()
+        self.cs.addKcycleHook(self.submit)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server and close its sockets, dropping the pending messages"""
+        self.cs.removeKcycleHook(self.submit)
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        for sock in [self._udp, self._tcp] + list(self._connections):
+            if sock:
+                sock.close()
+        self._connections = {}
+
+    def feed(self, data):
+        """Parse received bytes, made of complete lines, into the queues"""
+        c = self.counters
+        events = self._events
+        channels = self._channels
+        c['bytes'] += len(data)
+        with self._lock:
+            for line in data.decode('utf-8', 'replace').splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                c['lines'] += 1
+                if line[0] == '@':
+                    fields = line[1:].split()
+                    try:
+                        name, value = fields[0], float(fields[1])
+                    except (IndexError, ValueError):
+                        c['malformed'] += 1
+                        continue
+                    c['channelUpdates'] += 1
+                    if name in channels:
+                        c['coalesced'] += 1
+                    elif len(channels) >= self.maxChannels:
+                        c['droppedUpdates'] += 1
+                        continue
+                    channels[name] = value
+                else:
+                    c['events'] += 1
+                    if len(events) >= self.maxEvents:
+                        c['droppedEvents'] += 1
+                        if self.overflow == 'dropNewest':
+                            continue
+                        events.popleft()
+                    events.append(line)
+
+    def submit(self):
+        """Submit the pending messages, called before each k-cycle"""
+        if not self._events and not self._channels:
+            return
+        with self._lock:
+            channels, self._channels = self._channels, {}
+            events = self._events
+            n = min(len(events), self.eventsPerCycle)
+            batch = [events.popleft() for i in range(n)]
+        for name, value in channels.items():
+            self.cs.setControlChannel(name, value)
+        if batch:
+            self.cs.inputMessage('\n'.join(batch))
+        c = self.counters
+        c['batches'] += 1
+        c['submittedEvents'] += len(batch)
+        c['submittedUpdates'] += len(channels)
+
+    def stats(self):
+        """Return the counters, the pending counts and the rates per second"""
+        elapsed = max(time.time() - (self._started or time.time()), 1e-9)
+        stats = dict(self.counters)
+        stats['pendingEvents'] = len(self._events)
+        stats['pendingUpdates'] = len(self._channels)
+        for name in ('lines', 'bytes', 'submittedEvents', 'submittedUpdates'):
+            stats[name + 'PerSecond'] = self.counters[name] / elapsed
+        return stats
+
+    def _serve(self):
+        while self._running:
+            socks = [s for s in (self._udp, self._tcp) if s] + list(self._connections)
+            readable = select.select(socks, [], [], 0.05)[0]
+            for sock in readable:
+                if sock is self._udp:
+                    self.feed(sock.recv(65536))
+                elif sock is self._tcp:
+                    conn = sock.accept()[0]
+                    self._connections[conn] = b''
+                else:
+                    try:
+                        data = sock.recv(65536)
+                    except socket.error:
+                        data = b''
+                    if not data:
+                        del self._connections[sock]
+                        sock.close()
+                        continue
+                    data = self._connections[sock] + data
+                    end = data.rfind(b'\n') + 1
+                    self._connections[sock] = data[end:]
+                    if len(data) - end > 65536:
+                        # A line that long is not a message: discard it
+                        self.counters['malformed'] += 1
+                        self._connections[sock] = b''
+                    if end:
+                        self.feed(data[:end])
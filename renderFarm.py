@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# renderFarm.py:
+#
+# Copyright (C) 2016 Francois Pinot
+#
+# This code is free software; you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this code; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# 02111-1307 USA
+#
+
+import hashlib
+import multiprocessing
+import os
+import time
+import ctcsound
+
+
+_farmCsound = None
+
+def _initRenderWorker():
+    """Create the ctcsound.Csound instance owned by a render worker process"""
+    global _farmCsound
+    _farmCsound = ctcsound.Csound()
+    _farmCsound.createMessageBuffer(0)
+
+def _renderJob(job):
+    """Render one job in a worker process and return its result dict"""
+    index, csdPath, args, output, partial = job
+    cs = _farmCsound
+    t0 = time.time()
+    status = 'Error'
+    ret = cs.compile_("renderFarm", *(args + [csdPath]))
+    if ret == ctcsound.CSOUND_SUCCESS:
+        # perform() is negative when the performance failed
+        if cs.perform() >= 0:
+            status = 'OK'
+    log = ''
+    while cs.messageCnt() > 0:
+        log += cs.firstMessage()
+        cs.popFirstMessage()
+    cs.reset()
+    if partial:
+        if status == 'OK' and os.path.exists(partial):
+            os.rename(partial, output)
+        elif os.path.exists(partial):
+            os.remove(partial)
+    return {'index': index, 'status': status, 'wallTime': time.time() - t0,
+            'output': output if status == 'OK' else None,
+            'log': log if status != 'OK' else ''}
+
+
+class RenderFarm:
+    """Render batches of csd files or csd texts offline on a pool of processes
+
+    Each worker process owns one ctcsound.Csound instance that is reset
+    between jobs. When an output directory is given, each job renders to a
+    sound file named after a hash of its csd text and options, and jobs whose
+    file already exists are skipped. Without an output directory, jobs are
+    rendered with -n (no sound output).
+    """
+
+    def __init__(self, outputDir=None, options=None, processes=None, fileType='wav'):
+        self.outputDir = outputDir
+        self.options = list(options) if options else []
+        self.processes = processes or multiprocessing.cpu_count()
+        self.fileType = fileType
+        if self.outputDir and not os.path.exists(self.outputDir):
+            os.makedirs(self.outputDir)
+
+    def jobKey(self, csdText):
+        """Return the hash identifying a csd text rendered with the farm options"""
+        h = hashlib.sha1()
+        h.update(csdText.encode('utf-8'))
+        for opt in self.options + [self.fileType]:
+            h.update(b'\0' + opt.encode('utf-8'))
+        return h.hexdigest()
+
+    def render(self, csds):
+        """Render a list of csd file names or csd texts
+
+        Return a list of result dicts, in the order of the input list, with
+        the keys 'status' ('OK', 'Error' or 'Cached'), 'wallTime' (seconds),
+        'output' (the sound file path or None) and 'log' (the csound messages
+        of failed jobs).
+        """
+        results = [None] * len(csds)
+        jobs = []
+        tmpFiles = []
+        scheduled = {}
+        duplicates = []
+        for i, csd in enumerate(csds):
+            isText = '<CsoundSynthesizer>' in csd
+            if isText:
+                text, name = csd, 'render'
+            else:
+                with open(csd) as f:
+                    text = f.read()
+                name = os.path.splitext(os.path.basename(csd))[0]
+            key = self.jobKey(text)
+            if (name, key) in scheduled:
+                duplicates.append((i, scheduled[(name, key)]))
+                continue
+            scheduled[(name, key)] = i
+            args = ['-d'] + self.options
+            output = partial = None
+            if self.outputDir:
+                base = os.path.join(self.outputDir, '{}-{}'.format(name, key[:16]))
+                output = '{}.{}'.format(base, self.fileType)
+                if os.path.exists(output):
+                    results[i] = {'status': 'Cached', 'wallTime': 0.0,
+                                  'output': output, 'log': ''}
+                    continue
+                partial = '{}.part.{}'.format(base, self.fileType)
+                args += ['--format={}'.format(self.fileType), '-o', partial]
+            else:
+                args += ['-n']
+            csdPath = csd
+            if isText:
+                csdPath = os.path.join(self.outputDir or os.getcwd(),
+                                       '.{}-{}.csd'.format(name, key[:16]))
+                with open(csdPath, 'w') as f:
+                    f.write(text)
+                tmpFiles.append(csdPath)
+            jobs.append((i, csdPath, args, output, partial))
+        if jobs:
+            pool = multiprocessing.Pool(min(self.processes, len(jobs)),
+                                        initializer=_initRenderWorker)
+            try:
+                for res in pool.imap_unordered(_renderJob, jobs):
+                    results[res.pop('index')] = res
+            finally:
+                pool.close()
+                pool.join()
+                for path in tmpFiles:
+                    os.remove(path)
+        for i, first in duplicates:
+            results[i] = dict(results[first], wallTime=0.0)
+            if results[i]['status'] == 'OK':
+                results[i]['status'] = 'Cached'
+        return results
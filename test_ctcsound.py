@@ -21,7 +21,9 @@
 #
 
 import ctcsound, numpy as np, ctypes as ct
+import asyncio, importlib.util, os, shutil, socket, subprocess, sys, tempfile, time
 import unittest
+import csoundSession, asyncCsoundSession, audioBus, renderFarm
 
 
 class TestAttributes(unittest.TestCase):
@@ -101,5 +103,530 @@ class TestCsoundPerformanceThread(unittest.TestCase):
         self.assertEqual(self.cs.tableLength(1), 4096)
 
 
+class TestRenderFarm(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.outputDir = tempfile.mkdtemp()
+        self.farm = renderFarm.RenderFarm(self.outputDir, processes=2)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.outputDir)
+
+    def test_render(self):
+        with open("analogSynth01.csd") as f:
+            text = f.read()
+        results = self.farm.render(["analogSynth01.csd", text])
+        self.assertEqual(['OK', 'OK'], [r['status'] for r in results])
+        for r in results:
+            self.assertTrue(os.path.exists(r['output']))
+        results = self.farm.render(["analogSynth01.csd"])
+        self.assertEqual('Cached', results[0]['status'])
+
+
+class TestCsoundSession(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.cs = csoundSession.CsoundSession()
+        self.cs.csd = "analogSynth01.csd"
+
+    def test_stream(self):
+        direct = [b.copy() for b in self.cs.stream(prefetch=0)]
+        prefetched = [b.copy() for b in self.cs.stream(prefetch=4)]
+        self.assertEqual(len(direct), len(prefetched))
+        self.assertEqual(direct[0].shape[1], 2)
+        self.assertTrue(np.array_equal(np.concatenate(direct), np.concatenate(prefetched)))
+
+    def test_swapCsd(self):
+        length = sum(len(b) for b in self.cs.stream(prefetch=0))
+        swapped = 0
+        for i, b in enumerate(self.cs.stream(prefetch=0)):
+            swapped += len(b)
+            if i == 10:
+                self.assertTrue(self.cs.swapCsd("analogSynth01.csd", crossfade=0.1))
+        self.assertTrue(swapped > length)
+        cs = csoundSession.CsoundSession("simple.csd")
+        self.assertTrue(cs.swapCsd("simple.csd"))
+        self.assertEqual(cs.engineSwaps, 1)
+        self.assertEqual(cs.pt.status(), 0)
+        profiler = cs.startProfiling()
+        cs.sleep(200)
+        self.assertTrue(profiler.cycles > 0)
+        self.assertIsNone(profiler.load())
+        cs.stopProfiling()
+        cs.stopPerformance()
+
+    def test_renderToFile(self):
+        fileName = os.path.join(tempfile.mkdtemp(), "render.npy")
+        rendered = self.cs.renderToFile(fileName, dtype=ctcsound.MYFLT)
+        streamed = np.concatenate([b.copy() for b in self.cs.stream(prefetch=0)])
+        self.assertTrue(np.array_equal(rendered, streamed))
+        self.assertTrue(np.array_equal(np.load(fileName), streamed))
+        shutil.rmtree(os.path.dirname(fileName))
+
+    def test_renderSharded(self):
+        tmpDir = tempfile.mkdtemp()
+        single = self.cs.renderToFile(os.path.join(tmpDir, "single.npy"))
+        sharded = self.cs.renderSharded(os.path.join(tmpDir, "sharded.npy"),
+                                        segments=4, preroll=1.0)
+        n = min(len(single), len(sharded))
+        self.assertTrue(n > 0)
+        self.assertTrue(np.allclose(single[:n], sharded[:n], atol=1e-4))
+        shutil.rmtree(tmpDir)
+
+    def test_channelSampler(self):
+        sampler = csoundSession.ChannelSampler(self.cs, ["a", "b"], capacity=16, every=2)
+        sampler.attach(self.cs)
+        cycles = self.cs.performKsmpsLoop("-n")
+        self.assertEqual(sampler.count, (cycles + 1) // 2)
+        times, values = sampler.window()
+        self.assertEqual(values.shape, (15, 2))
+        self.assertTrue(np.all(np.diff(times) == 2000))
+        views = sampler._views
+        self.cs.performKsmpsLoop("-n")
+        sampler.detach()
+        self.assertEqual(sampler.count, cycles + 1)
+        self.assertIsNot(sampler._views, views)
+
+    def test_automation(self):
+        automation = self.cs.startAutomation()
+        automation.add("auto", np.arange(100.0))
+        automation.addBreakpoints("ramp", [0.0, 1.0], [0.0, 1.0], start=0.5)
+        sampler = csoundSession.ChannelSampler(self.cs, ["auto", "ramp"], capacity=256)
+        sampler.attach(self.cs)
+        self.cs.performKsmpsLoop("-n")
+        sampler.detach()
+        generation = self.cs.engineGeneration
+        self.cs.performKsmpsLoop("-n")
+        self.assertEqual(automation._plan[0], generation + 1)
+        self.cs.stopAutomation()
+        times, values = sampler.window()
+        cycles = times // 1000
+        self.assertTrue(np.array_equal(values[:, 0], np.minimum(cycles, 99)))
+        t = times / 48000.0
+        self.assertTrue(np.allclose(values[:, 1], np.clip(t - 0.5, 0.0, 1.0)))
+
+    def test_meter(self):
+        meter = self.cs.startMeter(fftSize=1024)
+        blocks = [b.copy() for b in self.cs.stream(prefetch=0)]
+        self.cs.stopMeter()
+        self.assertEqual(meter.pushed + meter.dropped, len(blocks))
+        self.assertEqual(meter.analyzed, meter.pushed)
+        self.assertTrue(np.all(meter.latest['truePeak'] >= meter.latest['peak']))
+        freqs, spectrum = meter.spectrum()
+        self.assertEqual(spectrum.shape, (2, 513))
+        self.assertEqual(freqs[-1], 24000)
+
+    def test_profiler(self):
+        profiler = self.cs.startProfiling()
+        cycles = self.cs.performKsmpsLoop("-n")
+        self.cs.stopProfiling()
+        self.assertEqual(profiler.cycles, cycles + 1)
+        self.assertAlmostEqual(profiler.budget, 1.0 / 48)
+        self.assertTrue(profiler.worst > 0)
+        self.assertTrue(0 < profiler.load())
+
+    def test_threadProfiler(self):
+        cs = csoundSession.CsoundSession("simple.csd")
+        profiler = cs.startProfiling()
+        self.assertIn(profiler.onCycle, cs._kcycleHooks)
+        cs.sleep(200)
+        cs.stopPerformance()
+        before = profiler.cycles
+        cs.csd = "analogSynth01.csd"
+        cycles = cs.performKsmpsLoop("-n")
+        self.assertEqual(profiler.cycles, before + cycles + 1)
+        self.assertNotIn(profiler.onCycle, cs._kcycleHooks)
+        cs.stopProfiling()
+
+    def test_scoreEvents(self):
+        cs = csoundSession.CsoundSession("simple.csd")
+        events = np.array([[2, 0, 1024, 10, 1, np.nan], [3, 0, 512, 10, 1, 0.5]])
+        cs.scoreEvents(events, 'f')
+        cs.flushMessages()
+        cs.sleep(500)
+        self.assertEqual(cs.tableLength(2), 1024)
+        self.assertEqual(cs.tableLength(3), 512)
+        cs.stopPerformance()
+
+    def test_eventTracer(self):
+        cs = csoundSession.CsoundSession("simple.csd")
+        tracer = cs.startTracing(capacity=64)
+        for i in range(10):
+            cs.scoreEvent('f', (10 + i, 0, 256, 10, 1))
+            cs.note((1, 0, 0.1, 0.1, 8, 10, 0.01, 0.01, 0.5))
+        cs.flushMessages()
+        cs.sleep(500)
+        lat = tracer.latencies()
+        self.assertEqual(len(lat['total']), 10)
+        self.assertTrue(np.all(lat['engineCycles'] >= 0))
+        self.assertIn('percentiles', tracer.toJSON())
+        cs.stopTracing()
+        cs.stopPerformance()
+
+    def test_tableSnapshot(self):
+        tmpDir = tempfile.mkdtemp()
+        fileName = os.path.join(tmpDir, "tables.arc")
+        cs = csoundSession.CsoundSession("simple.csd")
+        cs.compileOrc("gi1 ftgen 31, 0, 4096, 10, 1, 0.5\ngi2 ftgen 32, 0, 100, -7, 0, 100, 1")
+        saved = cs.snapshotTables(fileName, maxNum=100)
+        self.assertEqual(saved[-2:], [31, 32])
+        expected = [cs.table(n).copy() for n in (31, 32)]
+        cs.stopPerformance()
+        cs.resetSession()
+        cs.compileOrc("gi1 ftgen 31, 0, 16, 10, 1")
+        self.assertEqual(cs.restoreTables(fileName, [31, 32]), [31, 32])
+        for n, table in zip((31, 32), expected):
+            self.assertTrue(np.array_equal(cs.table(n), table))
+        cs.stopPerformance()
+        shutil.rmtree(tmpDir)
+
+    def test_ingestServer(self):
+        cs = csoundSession.CsoundSession("simple.csd")
+        server = cs.startIngest(udpPort=0, tcpPort=0)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(b"@level 0.25\n@level 0.5\nf 40 0 128 10 1\n", server.udpAddress)
+        conn = socket.create_connection(server.tcpAddress)
+        conn.sendall(b"f 41 0 64 10 1\n")
+        cs.sleep(500)
+        self.assertEqual(cs.controlChannel("level")[0], 0.5)
+        self.assertEqual(cs.tableLength(40), 128)
+        self.assertEqual(cs.tableLength(41), 64)
+        stats = server.stats()
+        self.assertEqual(stats['submittedEvents'], 2)
+        self.assertEqual(stats['pendingEvents'], 0)
+        conn.close()
+        sock.close()
+        server.stop()
+        cs.stopPerformance()
+
+    def test_streamScore(self):
+        tmpDir = tempfile.mkdtemp()
+        fileName = os.path.join(tmpDir, "stream.sco")
+        with open(fileName, 'w') as f:
+            f.write("f 20 0 256 10 1\nf 21 0.2 512 10 1\nf 22 30 1024 10 1\n")
+        cs = csoundSession.CsoundSession("simple.csd")
+        stream = cs.streamScore(fileName, lookahead=1.0, interval=0.01)
+        cs.sleep(500)
+        self.assertEqual(cs.tableLength(20), 256)
+        self.assertEqual(cs.tableLength(21), 512)
+        self.assertEqual(cs.tableLength(22), -1)
+        self.assertEqual(stream.sent, 2)
+        cs.stopPerformance()
+        self.assertTrue(stream.done())
+        shutil.rmtree(tmpDir)
+
+    def test_scoreEnd(self):
+        self.assertEqual(csoundSession.scoreEnd("i 1 0 2\ni 1 + 3\ns\ni1 1 1\n"), 7.0)
+        self.assertEqual(csoundSession.scoreEnd("i 1 0\nf0\ni 2 1 1\nf 0 4\n"), 4.0)
+        csd = "<CsoundSynthesizer><CsInstruments>\ninstr 1\nendin\n</CsInstruments>"
+        self.assertEqual(csoundSession.scoreEnd(csd + "</CsoundSynthesizer>"), 0.0)
+        self.assertEqual(csoundSession.scoreEnd(csd + "<CsScore>\ni 1 1 1\n</CsScore>"), 2.0)
+
+
+class TestAudioPipeline(unittest.TestCase):
+    source = """<CsoundSynthesizer>
+<CsInstruments>
+sr     = 1024
+ksmps  = 128
+nchnls = 1
+0dbfs  = 1
+
+          instr 1
+a1        oscili    0.9, 100
+          out       a1
+          endin
+</CsInstruments>
+<CsScore>
+i 1 0 2
+e
+</CsScore>
+</CsoundSynthesizer>
+"""
+
+    def test_pipeline(self):
+        tmpDir = tempfile.mkdtemp()
+        source = os.path.join(tmpDir, "source.csd")
+        with open(source, 'w') as f:
+            f.write(self.source)
+        single = audioBus.AudioPipeline([source], bufferSize=256)
+        direct = np.concatenate([b.copy() for b in single])
+        single.close()
+        chain = audioBus.AudioPipeline([source, "bufferInOut.csd"], bufferSize=256)
+        piped = np.concatenate([b.copy() for b in chain])
+        chain.close()
+        self.assertEqual(piped.shape[1], 1)
+        self.assertTrue(len(piped) > 0)
+        self.assertTrue(np.allclose(piped, direct[:len(piped)] / 3.0))
+        shutil.rmtree(tmpDir)
+
+
+class TestAsyncCsoundSession(unittest.TestCase):
+    def test_scoreEvent(self):
+        async def run():
+            acs = asyncCsoundSession.AsyncCsoundSession("simple.csd")
+            await acs.scoreEvent('f', (4, 0, 2048, 10, 1))
+            await acs.flushMessages()
+            await asyncio.sleep(0.5)
+            length = acs.session.tableLength(4)
+            await acs.stopPerformance()
+            messages = [text async for attr, text in acs.messages()]
+            acs.close()
+            return length, messages
+        length, messages = asyncio.run(run())
+        self.assertEqual(length, 2048)
+        self.assertTrue(len(messages) > 0)
+
+
+class TestCsoundmagicsImport(unittest.TestCase):
+    @unittest.skipUnless(importlib.util.find_spec('IPython'), 'IPython not installed')
+    def test_lazyImports(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'cookbook', 'csoundmagics')
+        code = ('import sys; sys.path.insert(0, {!r}); import csoundmagics; '
+                'print(" ".join(m for m in ("ctcsound", "numpy", "matplotlib") '
+                'if m in sys.modules))').format(path)
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.decode().strip(), '')
+
+
+class _FakeEngine:
+    """A stand-in for an ICsound engine with a message buffer, tables and
+    channels, compiling any code not containing 'error' and performing
+    length k-cycles of 10 ms"""
+    def __init__(self, length=0):
+        self.messages = []
+        self.compiled = []
+        self.tables = {}
+        self.views = {}
+        self.incrementalCode = False
+        self._clientAddr = None
+        self._blockHashes = {}
+        self._envelopes = {}
+        self.messageLog = None
+        self.length = length
+        self.cycles = 0
+        self.cleanedUp = False
+
+    def ksmps(self):
+        return 441
+
+    def sr(self):
+        return 44100.0
+
+    def performKsmps(self):
+        self.cycles += 1
+        return 0 if self.cycles <= self.length else 2
+
+    def cleanup(self):
+        self.cleanedUp = True
+
+    def messageCnt(self):
+        return len(self.messages)
+
+    def firstMessageAttr(self):
+        return self.messages[0][0]
+
+    def firstMessage(self):
+        return self.messages[0][1]
+
+    def popFirstMessage(self):
+        self.messages.pop(0)
+
+    def compileOrc(self, code):
+        self.compiled.append(code)
+        if 'error' in code:
+            self.messages.append((ctcsound.CSOUNDMSG_ERROR, 'error: syntax error\n'))
+            return 1
+        return 0
+
+    def table(self, num):
+        return self.tables.get(num)
+
+    def channelPtr(self, name, type_):
+        return self.views[name], ''
+
+    def _flushMessages(self):
+        self.messageLog.drain()
+
+
+@unittest.skipUnless(importlib.util.find_spec('IPython'), 'IPython not installed')
+class TestCsoundmagics(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'cookbook', 'csoundmagics')
+        if path not in sys.path:
+            sys.path.insert(0, path)
+        cls.magics = importlib.import_module('csoundmagics')
+
+    def setUp(self):
+        self.engine = _FakeEngine()
+        self.engine.messageLog = self.magics.MessageLog(self.engine, 4, 0)
+
+    def test_splitOrc(self):
+        code = ("gkAmp init 0.5\n\n"
+                "instr 1, Lead\nout oscili(gkAmp, p4)\nendin\n"
+                "giSine ftgen 0, 0, 8192, 10, 1\n"
+                "opcode Gain, a, ak\nxin\nendop\n  \n")
+        blocks = self.magics.splitOrc(code)
+        self.assertEqual([key for key, text in blocks],
+                         ['global', 'instr 1,Lead', 'global', 'opcode Gain'])
+        self.assertEqual(''.join(text for key, text in blocks), code.rstrip(' \n') + '\n')
+        self.assertEqual(self.magics.splitOrc("instr 2\nendin"), [('instr 2', "instr 2\nendin")])
+        commented = ("instr 3 ; lead\n/* the body\nendin\n*/ a1 oscili 0.5, 440 /* endin */\n"
+                     "out a1 // endin\nendin\n/*\ninstr 4\n*/\n")
+        blocks = self.magics.splitOrc(commented)
+        self.assertEqual([key for key, text in blocks], ['instr 3', 'global'])
+        self.assertTrue(blocks[0][1].endswith("out a1 // endin\nendin\n"))
+
+    def test_incrementalSendCode(self):
+        sendCode = self.magics.ICsound.sendCode
+        code = "giA = 1\ninstr 1\nendin\ninstr 2\nendin\n"
+        self.assertEqual(sendCode(self.engine, code, True), [])
+        self.assertEqual(sendCode(self.engine, code, True), ['global', 'instr 1', 'instr 2'])
+        self.assertEqual(len(self.engine.compiled), 1)
+        self.assertEqual(sendCode(self.engine, code.replace("instr 2\n", "instr 2\nprints \"x\"\n"),
+                                  True), ['global', 'instr 1'])
+        self.assertEqual(self.engine.compiled[-1], "instr 2\nprints \"x\"\nendin\n")
+        failing = "instr 3\nerror\nendin\n"
+        self.assertEqual(sendCode(self.engine, failing, True), [])
+        self.assertNotIn('instr 3', self.engine._blockHashes)
+        self.assertEqual(sendCode(self.engine, failing, True), [])
+        self.assertEqual(self.engine.compiled[-2:], [failing, failing])
+        sendCode(self.engine, code)
+        self.assertEqual(self.engine.compiled[-1], code)
+
+    def test_channelBank(self):
+        # Views one byte apart are not MYFLT aligned with each other
+        itemSize = ct.sizeof(ctcsound.MYFLT)
+        buf = np.zeros(4 * itemSize, dtype=np.uint8)
+        for i, name in enumerate('abc'):
+            self.engine.views[name] = np.frombuffer(buf, ctcsound.MYFLT, 1, i * (itemSize + 1))
+        bank = self.magics.ChannelBank(self.engine, 'abc')
+        self.assertIsNone(bank._base)
+        bank.write([1, 2, 3])
+        self.assertEqual([self.engine.views[name][0] for name in 'abc'], [1, 2, 3])
+        self.engine.views['b'][0] = 5
+        self.assertEqual(list(bank.read()), [1, 5, 3])
+        bank['c'] = 4
+        self.assertEqual(bank['c'], 4)
+        values = np.zeros(4, dtype=ctcsound.MYFLT)
+        aligned = np.zeros(8, dtype=ctcsound.MYFLT)
+        self.engine.views = {'x': aligned[5:6], 'y': aligned[1:2]}
+        bank = self.magics.ChannelBank(self.engine, 'xy')
+        self.assertIsNotNone(bank._base)
+        bank.write([6, 7])
+        self.assertEqual(list(aligned[[5, 1]]), [6, 7])
+        self.assertEqual(list(bank.read(values[:2])), [6, 7])
+
+    def test_clientTransport(self):
+        transport = self.magics.ClientTransport(port=0, maxDatagram=128, flushInterval=60)
+        sent = []
+        transport._send = sent.append
+        try:
+            transport.sendScore("i 1 0 1\n\ni 1 1 1\n")
+            transport.sendCode("instr 1\nendin")
+            transport.sendScore("i 2 0 1")
+            self.assertEqual(sent, [])
+            transport.flush()
+            self.assertEqual(sent, ["scoreline_i {{i 1 0 1\ni 1 1 1}}\ninstr 1\nendin\n"
+                                    "scoreline_i {{i 2 0 1}}\n"])
+            del sent[:]
+            lines = ["i 1 {} 1".format(i) for i in range(20)]
+            transport.sendScore('\n'.join(lines))
+            transport.flush()
+            self.assertTrue(len(sent) > 1)
+            self.assertTrue(all(len(m) <= 128 for m in sent))
+            self.assertTrue(all(m.startswith("scoreline_i {{") for m in sent))
+            self.assertEqual(''.join(m[14:-3] + '\n' for m in sent), '\n'.join(lines) + '\n')
+            del sent[:]
+            transport.sendTable(7, [0.5, 1, 2])
+            transport.flush()
+            self.assertEqual(sent, ["gitemp ftgen 7, 0, 3, -2, 0\n"
+                                    "iarr_[] fillarray 0.5,1,2\ncopya2ftab iarr_, 7, 0\n"])
+        finally:
+            transport.close()
+
+    def test_messageLog(self):
+        log = self.engine.messageLog
+        self.engine.messages = [(0, 'a\n'), (ctcsound.CSOUNDMSG_ERROR, 'error 1\n')]
+        log.drain()
+        mark = log.mark()
+        self.engine.messages = [(0, 'b\n'), (0, 'c\n'), (ctcsound.CSOUNDMSG_ERROR, 'error 2\n')]
+        log.drain()
+        self.assertEqual(len(log), 4)
+        self.assertEqual(log.text(), 'error 1\nb\nc\nerror 2\n')
+        self.assertEqual(log.text(log.since(mark)), 'b\nc\nerror 2\n')
+        self.assertEqual(log.text(log.tail(2)), 'c\nerror 2\n')
+        self.assertEqual(log.text(log.tail(0, ctcsound.CSOUNDMSG_ERROR)), 'error 1\nerror 2\n')
+        self.assertEqual([r.text for r in log.search(r'error \d')], ['error 1\n', 'error 2\n'])
+        self.assertEqual(log.search('b', ctcsound.CSOUNDMSG_ERROR), [])
+        log.clear()
+        self.assertEqual(log.tail(), [])
+
+    def test_tableEnvelope(self):
+        tableEnvelope = self.magics.ICsound.tableEnvelope
+        table = np.sin(np.arange(100000) / 100.0).astype(ctcsound.MYFLT)
+        self.engine.tables[1] = table
+        x, low, high = tableEnvelope(self.engine, 1, 500)
+        self.assertEqual(len(x), 500)
+        self.assertEqual(x[1], 200)
+        self.assertEqual(low[0], table[:200].min())
+        self.assertEqual(high[-1], table[-200:].max())
+        self.assertIs(tableEnvelope(self.engine, 1, 500)[0], x)
+        table[50001] = 7
+        self.magics.ICsound.invalidateTable(self.engine, 1)
+        x, low, high = tableEnvelope(self.engine, 1, 500)
+        self.assertEqual(high[250], 7)
+        x, low, high = tableEnvelope(self.engine, 1, 500, 1000, 1500)
+        self.assertIs(low, high)
+        self.assertEqual(list(x), list(range(1000, 1500)))
+        self.assertIsNone(tableEnvelope(self.engine, 2))
+
+    def test_engineDriver(self):
+        driver = self.magics.EngineDriver(2)
+        engines = [_FakeEngine(10) for i in range(3)]
+        perfs = [driver.attach(cs) for cs in engines]
+        self.assertEqual([len(lane) for lane in driver._lanes], [2, 1])
+        self.assertFalse(perfs[0].isRunning())
+        for perf in perfs:
+            perf.play()
+        self.assertEqual([perf.join() for perf in perfs], [2, 2, 2])
+        self.assertEqual([cs.cycles for cs in engines], [11, 11, 11])
+        self.assertTrue(all(cs.cleanedUp for cs in engines))
+        endless = _FakeEngine(1000)
+        perf = driver.attach(endless)
+        perf.play()
+        time.sleep(0.05)
+        perf.stop()
+        self.assertEqual(perf.join(), 1)
+        self.assertTrue(0 < endless.cycles < 1000)
+        paused, playing = _FakeEngine(1000), _FakeEngine(1000)
+        perfs = [driver.attach(paused), driver.attach(playing)]
+        perfs[1].play()
+        driver.shutdown()
+        self.assertEqual([perf.join() for perf in perfs], [1, 1])
+        self.assertEqual(paused.cycles, 0)
+        self.assertEqual(driver.engineCount(), 0)
+        self.assertFalse(any(t.is_alive() for t in driver._threads))
+
+    def test_enginePool(self):
+        pool = self.magics.EnginePool(2, ['-d', '-n'])
+        orc = "giCount init 0\ninstr 1\ngiCount += 1\nendin\n"
+        jobs = [pool.submitOrcSco(orc, "i 1 0 0.1\n") for i in range(4)]
+        self.assertEqual([job.result() for job in jobs], ['OK'] * 4)
+        self.assertEqual(pool.renderOrcSco("instr 1\nfoo\nendin\n", "i 1 0 0.1\n"),
+                         'Error in orchestra')
+        self.assertEqual(len(pool._orcErrors), 1)
+        self.assertEqual(pool.renderOrcSco("instr 1\nfoo\nendin\n", "i 1 0 0.1\n"),
+                         'Error in orchestra')
+        csd = ("<CsoundSynthesizer>\n<CsInstruments>\n{}</CsInstruments>\n"
+               "<CsScore>\ni 1 0 0.1\n</CsScore>\n</CsoundSynthesizer>\n").format(orc)
+        self.assertEqual(pool.renderCsd(csd), 'OK')
+        pool.shutdown()
+        self.assertEqual(len(pool._engines), 0)
+
+
 if __name__ == '__main__':
     unittest.main()